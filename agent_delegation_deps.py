@@ -3,9 +3,15 @@ from dataclasses import dataclass
 
 import httpx
 from byeprint import p
-from pydantic_ai import Agent, RunContext
+from pydantic_ai import Agent, RunContext, UsageLimits
 
 from constant import model
+from delegation import fan_out, merge_lists, split_count
+from http_clients import HTTP_CLIENTS
+
+# more jokes are generated by several runs at once
+JOKES_PER_RUN = 5
+usage_limits = UsageLimits(request_limit=15)
 
 
 @dataclass
@@ -34,12 +40,14 @@ joke_generation_agent = Agent(
 
 @joke_selection_agent.tool
 async def joke_factory(ctx: RunContext[ClientAndKey], count: int) -> list[str]:
-  r = await joke_generation_agent.run(
-    f'Please generate {count} jokes.',
-    deps=ctx.deps,  # type: ignore
+  outputs = await fan_out(
+    joke_generation_agent,
+    [f'Please generate {n} jokes.' for n in split_count(count, JOKES_PER_RUN)],
+    deps=ctx.deps,
     usage=ctx.usage,
+    usage_limits=usage_limits,
   )
-  return r.output
+  return merge_lists(outputs)
 
 
 @joke_generation_agent.tool
@@ -56,10 +64,10 @@ async def get_jokes(ctx: RunContext[ClientAndKey], count: int) -> str:
 
 
 async def main():
-  async with httpx.AsyncClient() as client:
-    deps = ClientAndKey(client, 'foobar')
+  async with HTTP_CLIENTS:
+    deps = ClientAndKey(HTTP_CLIENTS.get(), 'foobar')
     p(deps)
-    result = await joke_selection_agent.run('Tell me a joke.', deps=deps)
+    result = await joke_selection_agent.run('Tell me a joke.', deps=deps, usage_limits=usage_limits)
     p(result.output)
     p(result.usage())
 
@@ -1,6 +1,11 @@
 from pydantic_ai import Agent, RunContext, UsageLimits
 
 from constant import model
+from delegation import fan_out, merge_lists, split_count
+
+# more jokes are generated by several runs at once
+JOKES_PER_RUN = 5
+usage_limits = UsageLimits(request_limit=5, total_tokens_limit=2000)
 
 joke_selection_agent = Agent(
   model=model,
@@ -13,16 +18,18 @@ joke_generation_agent = Agent(model=model, output_type=list[str])
 
 @joke_selection_agent.tool
 async def joke_factory(ctx: RunContext[None], count: int) -> list[str] | str:
-  r = await joke_generation_agent.run(
-    f'Please generate {count} jokes.',
+  outputs = await fan_out(
+    joke_generation_agent,
+    [f'Please generate {n} jokes.' for n in split_count(count, JOKES_PER_RUN)],
     usage=ctx.usage,
+    usage_limits=usage_limits,
   )
-  return r.output
+  return merge_lists(outputs)
 
 
 result = joke_selection_agent.run_sync(
   'Tell me a joke.',
-  usage_limits=UsageLimits(request_limit=5, total_tokens_limit=2000),
+  usage_limits=usage_limits,
 )
 print(result.output)
 print(result.usage())
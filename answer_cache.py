@@ -0,0 +1,110 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from embeddings import Vector
+
+
+@dataclass
+class Answer:
+  question: str
+  answer: str
+  sources: list[str]
+  similarity: float = 1.0
+
+
+class SemanticAnswerCache:
+  """SQLite cache of agent answers, looked up by cosine similarity of the question embedding.
+
+  Each answer remembers the documentation URLs it was built from, so re-indexing a section
+  only invalidates the answers that depended on it.
+  """
+
+  def __init__(self, path: str | Path, threshold: float = 0.95, ttl: float = 24 * 60 * 60) -> None:
+    self.threshold = threshold
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    self._conn.executescript(
+      """
+      PRAGMA journal_mode = WAL;
+      PRAGMA foreign_keys = ON;
+      CREATE TABLE IF NOT EXISTS answers (
+          id INTEGER PRIMARY KEY,
+          question TEXT NOT NULL,
+          embedding BLOB NOT NULL,
+          answer TEXT NOT NULL,
+          created_at REAL NOT NULL
+      );
+      CREATE TABLE IF NOT EXISTS answer_sources (
+          answer_id INTEGER NOT NULL REFERENCES answers (id) ON DELETE CASCADE,
+          url TEXT NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS idx_answer_sources_url ON answer_sources (url);
+      """
+    )
+
+  async def lookup(self, embedding: Vector) -> Answer | None:
+    """Return the cached answer to the most similar unexpired question, if above the threshold."""
+    return await asyncio.to_thread(self._lookup, embedding)
+
+  async def store(self, question: str, embedding: Vector, answer: str, sources: Iterable[str]) -> None:
+    await asyncio.to_thread(self._store, question, embedding, answer, sorted(set(sources)))
+
+  def invalidate(self, urls: Iterable[str]) -> int:
+    """Drop answers that used any of `urls`, returning how many were dropped."""
+    urls = list(urls)
+    with self._lock, self._conn:
+      deleted = 0
+      for i in range(0, len(urls), 500):
+        chunk = urls[i : i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        deleted += self._conn.execute(
+          f'DELETE FROM answers WHERE id IN (SELECT answer_id FROM answer_sources WHERE url IN ({placeholders}))',
+          chunk,
+        ).rowcount
+      return deleted
+
+  def clear(self) -> None:
+    with self._lock, self._conn:
+      self._conn.execute('DELETE FROM answers')
+
+  def close(self) -> None:
+    self._conn.close()
+
+  def _lookup(self, embedding: Vector) -> Answer | None:
+    with self._lock, self._conn:
+      self._conn.execute('DELETE FROM answers WHERE created_at < ?', (time.time() - self.ttl,))
+      rows = self._conn.execute('SELECT id, question, embedding, answer FROM answers').fetchall()
+    if not rows:
+      return None
+
+    matrix = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+    query = np.asarray(embedding, dtype=np.float32)
+    similarities = (matrix @ query) / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+    best = int(np.argmax(similarities))
+    if similarities[best] < self.threshold:
+      return None
+
+    answer_id, question, _, answer = rows[best]
+    with self._lock:
+      sources = [url for (url,) in self._conn.execute('SELECT url FROM answer_sources WHERE answer_id = ?', (answer_id,))]
+    return Answer(question, answer, sources, float(similarities[best]))
+
+  def _store(self, question: str, embedding: Vector, answer: str, sources: list[str]) -> None:
+    with self._lock, self._conn:
+      answer_id = self._conn.execute(
+        'INSERT INTO answers (question, embedding, answer, created_at) VALUES (?, ?, ?, ?)',
+        (question, np.asarray(embedding, dtype=np.float32).tobytes(), answer, time.time()),
+      ).lastrowid
+      self._conn.executemany(
+        'INSERT INTO answer_sources (answer_id, url) VALUES (?, ?)', [(answer_id, url) for url in sources]
+      )
@@ -1,58 +1,291 @@
 from __future__ import annotations as _annotations
 
+import asyncio
 import json
+import os
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator
 from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from datetime import UTC, datetime
 from pathlib import Path
 from typing import Annotated, Literal
+from uuid import uuid4
 
 import fastapi
+import logfire
 from fastapi import Depends
 from fastapi.responses import FileResponse, Response, StreamingResponse
-from pydantic_ai import Agent, UnexpectedModelBehavior
+from pydantic import TypeAdapter
+from pydantic_ai import Agent, RunContext
+from pydantic_ai.capabilities import ProcessHistory
 from pydantic_ai.messages import (
   ModelMessage,
+  ModelMessagesTypeAdapter,
   ModelRequest,
-  ModelResponse,
+  SystemPromptPart,
   TextPart,
   UserPromptPart,
 )
-from sqlmodel import Field, Session, SQLModel, create_engine, select
-from typing_extensions import TypedDict
-
+from sqlalchemy import Connection, Index, delete, event, inspect, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import Field, SQLModel, col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing_extensions import NotRequired, TypedDict
+
+from chat_history import summarize, window_start
 from constant import model
 
-agent = Agent(model=model)
 THIS_DIR = Path(__file__).parent
+# conversation used by clients that don't send a `conversation_id`
+DEFAULT_CONVERSATION_ID = 'default'
+# approximate tokens of recent history sent to the model, older turns are summarized
+HISTORY_TOKEN_BUDGET = 4000
+# shared by every worker, use e.g. `postgresql+asyncpg://...` when workers run on several hosts
+DATABASE_URL = os.getenv('CHAT_DATABASE_URL', 'sqlite+aiosqlite:///database.db')
+# how often a generating worker writes new stream events to the shared stream log
+STREAM_FLUSH_INTERVAL = 0.25
+# how often a resumed stream polls the stream log for new events
+STREAM_POLL_INTERVAL = 0.25
+# a resumed stream ends if the generating worker hasn't written anything for this long
+STREAM_STALL_TIMEOUT = 60
+# stream events are kept this long, after that only the persisted messages remain
+STREAM_RETENTION = 15 * 60
+# latest events of each stream kept in memory by the worker generating it
+STREAM_BUFFER_EVENTS = 1024
+# how long a finished stream stays in memory, for clients reattaching just after it ended
+STREAM_BUFFER_TTL = 60
+# latest cached rows of a conversation read again when topping it up, since on Postgres ids are
+# taken before commit, a row can become visible after rows with higher ids
+HISTORY_REREAD_ROWS = 8
+
+
+@dataclass
+class ChatDeps:
+  conversation_id: str
+  # set by `window_history`, later requests of the run get the history it returned, which starts with
+  # this summary in place of the conversation's first `summary_offset` messages
+  summary_request: ModelRequest | None = None
+  summary_offset: int = 0
+
+
+async def window_history(ctx: RunContext[ChatDeps], messages: list[ModelMessage]) -> list[ModelMessage]:
+  """Keep the most recent turns within `HISTORY_TOKEN_BUDGET`, replacing older ones with a rolling summary.
+
+  The summary is persisted per conversation and covers its first `message_count` messages. It's only
+  recomputed once turns that it doesn't cover fall out of the window, and then down to half the
+  budget, so it stays fresh for the next few turns.
+  """
+  # positions in `messages` are turned into positions in the stored conversation
+  offset = 0
+  if messages and messages[0] is ctx.deps.summary_request:
+    messages, offset = messages[1:], ctx.deps.summary_offset
+  start = offset + window_start(messages, HISTORY_TOKEN_BUDGET)
+  if start == 0:
+    return messages
+
+  async with AsyncSession(engine, expire_on_commit=False) as session:
+    summary = await session.get(ConversationSummaryDB, ctx.deps.conversation_id)
+    if summary is None or summary.message_count < start:
+      summarized = summary.message_count if summary else 0
+      new_start = offset + window_start(messages, HISTORY_TOKEN_BUDGET // 2)
+      text = await summarize(
+        ctx, summary.summary if summary else None, messages[max(summarized - offset, 0) : new_start - offset]
+      )
+      summary = ConversationSummaryDB(conversation_id=ctx.deps.conversation_id, summary=text, message_count=new_start)
+      summary = await session.merge(summary)
+      await session.commit()
+
+  summary_request = ModelRequest(parts=[SystemPromptPart(f'Summary of the earlier conversation:\n{summary.summary}')])
+  ctx.deps.summary_request = summary_request
+  ctx.deps.summary_offset = summary.message_count
+  return [summary_request, *messages[max(summary.message_count - offset, 0) :]]
+
+
+agent = Agent(model=model, deps_type=ChatDeps, capabilities=[ProcessHistory(window_history)])
 
 
 class ChatMessageDB(SQLModel, table=True):
+  __table_args__ = (Index('ix_chatmessagedb_conversation_id_id', 'conversation_id', 'id'),)
+
   id: int | None = Field(default=None, primary_key=True)
+  conversation_id: str = Field(default=DEFAULT_CONVERSATION_ID)
   message_json: str
 
 
-sqlite_file_name = 'database.db'
-sqlite_url = f'sqlite:///{sqlite_file_name}'
-connect_args = {'check_same_thread': False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+class ChatStreamEventDB(SQLModel, table=True):
+  """Event of a model response stream, so any worker can replay it to a client resuming the stream."""
+
+  stream_id: str = Field(primary_key=True)
+  seq: int = Field(primary_key=True)
+  event_json: str
+  done: bool = False
+  created_at: float = Field(default_factory=time.time, index=True)
+
+
+class ConversationSummaryDB(SQLModel, table=True):
+  """Rolling summary of the first `message_count` messages of a conversation."""
+
+  conversation_id: str = Field(primary_key=True)
+  summary: str
+  message_count: int
+
+
+model_message_ta: TypeAdapter[ModelMessage] = TypeAdapter(ModelMessage)
+
 
+engine = create_async_engine(DATABASE_URL, pool_size=8, max_overflow=8)
 
-def create_db_and_tables():
-  SQLModel.metadata.create_all(engine)
 
+def set_sqlite_pragmas(dbapi_connection, _connection_record):  # pyright: ignore[reportUnknownParameterType,reportMissingParameterType]
+  # WAL lets readers proceed while the writer commits, NORMAL sync is durable enough in WAL mode
+  cursor = dbapi_connection.cursor()  # pyright: ignore[reportUnknownMemberType,reportUnknownVariableType]
+  cursor.execute('PRAGMA journal_mode = WAL')  # pyright: ignore[reportUnknownMemberType]
+  cursor.execute('PRAGMA synchronous = NORMAL')  # pyright: ignore[reportUnknownMemberType]
+  cursor.execute('PRAGMA busy_timeout = 5000')  # pyright: ignore[reportUnknownMemberType]
+  cursor.close()  # pyright: ignore[reportUnknownMemberType]
 
-def get_session():
-  with Session(engine) as session:
+
+if engine.dialect.name == 'sqlite':
+  event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+
+
+def create_tables(conn: Connection):
+  # tables created before conversations existed only need the new column, the index is created below
+  if inspect(conn).has_table('chatmessagedb'):
+    columns = {column['name'] for column in inspect(conn).get_columns('chatmessagedb')}
+    if 'conversation_id' not in columns:
+      conn.execute(
+        text(f"ALTER TABLE chatmessagedb ADD COLUMN conversation_id VARCHAR NOT NULL DEFAULT '{DEFAULT_CONVERSATION_ID}'")
+      )
+  SQLModel.metadata.create_all(conn)
+  for index in ChatMessageDB.__table__.indexes:  # pyright: ignore[reportAttributeAccessIssue]
+    index.create(conn, checkfirst=True)
+
+
+async def create_db_and_tables():
+  try:
+    async with engine.begin() as conn:
+      await conn.run_sync(create_tables)
+  except DBAPIError:
+    # workers start together, so another one may have created a table between the check and the create
+    async with engine.begin() as conn:
+      await conn.run_sync(create_tables)
+
+
+async def get_session():
+  async with AsyncSession(engine) as session:
     yield session
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
+
+
+class MessageWriter:
+  """Write-behind queue that group-commits the new messages and stream events of every conversation.
+
+  `add` returns without touching the database, a single background task commits everything
+  queued so far in one transaction, so concurrent chats share commits instead of each paying one.
+  The future `add` returns is resolved once its messages are committed, or fails with the error.
+  """
+
+  def __init__(self, engine: AsyncEngine, max_batch: int = 1000) -> None:
+    self.engine = engine
+    self.max_batch = max_batch
+    self._queue: asyncio.Queue[tuple[asyncio.Future[None] | None, list[SQLModel]]] = asyncio.Queue()
+    # queued writes per conversation, so reads from the database can wait for them
+    self._pending: dict[str, set[asyncio.Future[None]]] = {}
+    self._task: asyncio.Task[None] | None = None
+
+  def start(self) -> None:
+    self._task = asyncio.create_task(self._run())
+
+  async def stop(self) -> None:
+    await self._queue.join()
+    if self._task is not None:
+      self._task.cancel()
+
+  def add(self, conversation_id: str, messages: list[ModelMessage]) -> asyncio.Future[None]:
+    written: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+    pending = self._pending.setdefault(conversation_id, set())
+    pending.add(written)
+
+    def done(_: asyncio.Future[None]) -> None:
+      pending.discard(written)
+      if not pending and self._pending.get(conversation_id) is pending:
+        del self._pending[conversation_id]
+
+    written.add_done_callback(done)
+    rows: list[SQLModel] = [
+      ChatMessageDB(conversation_id=conversation_id, message_json=model_message_ta.dump_json(message).decode())
+      for message in messages
+    ]
+    self._queue.put_nowait((written, rows))
+    return written
+
+  def add_rows(self, rows: list[SQLModel]) -> None:
+    """Queue rows that aren't part of a conversation's messages, so reads don't wait for them."""
+    self._queue.put_nowait((None, rows))
+
+  async def wait_for(self, conversation_id: str) -> None:
+    """Wait until every queued message of the conversation is written, or failed to be."""
+    pending = self._pending.get(conversation_id)
+    if pending:
+      await asyncio.wait(set(pending))
+
+  async def _run(self) -> None:
+    while True:
+      batch = [await self._queue.get()]
+      while not self._queue.empty() and len(batch) < self.max_batch:
+        batch.append(self._queue.get_nowait())
+
+      error: Exception | None = None
+      try:
+        async with AsyncSession(self.engine) as session:
+          session.add_all(row for _, rows in batch for row in rows)
+          await session.commit()
+      except Exception as exc:
+        logfire.exception('Failed to write {count} chat message batches', count=len(batch))
+        error = exc
+      for written, _ in batch:
+        if written is not None and not written.done():
+          if error is None:
+            written.set_result(None)
+          else:
+            written.set_exception(error)
+        self._queue.task_done()
+
+
+message_writer = MessageWriter(engine)
+# model responses being generated by this worker, they outlive the request that started them
+generations: set[asyncio.Task[None]] = set()
+
+
+async def prune_stream_events():
+  while True:
+    try:
+      async with AsyncSession(engine) as session:
+        await session.exec(delete(ChatStreamEventDB).where(col(ChatStreamEventDB.created_at) < time.time() - STREAM_RETENTION))
+        await session.commit()
+    except Exception:
+      logfire.exception('Failed to prune stream events')
+    await asyncio.sleep(60)
 
 
 @asynccontextmanager
 async def lifespan(_app: fastapi.FastAPI):
-  create_db_and_tables()
+  await create_db_and_tables()
+  message_writer.start()
+  pruner = asyncio.create_task(prune_stream_events())
   yield
+  pruner.cancel()
+  # let in-flight responses finish so their messages are persisted before the writer stops
+  if generations:
+    await asyncio.wait(generations, timeout=30)
+  await message_writer.stop()
+  await engine.dispose()
 
 
 app = fastapi.FastAPI(lifespan=lifespan)
@@ -76,84 +309,348 @@ class ChatMessage(TypedDict):
   content: str
 
 
-def to_chat_message(m: ModelMessage) -> ChatMessage:
-  first_part = m.parts[0]
-  if isinstance(m, ModelRequest):
-    if isinstance(first_part, UserPromptPart):
-      assert isinstance(first_part.content, str)
-      return {
-        'role': 'user',
-        'timestamp': first_part.timestamp.isoformat(),
-        'content': first_part.content,
-      }
-  elif isinstance(m, ModelResponse):
-    if isinstance(first_part, TextPart):
-      return {
-        'role': 'model',
-        'timestamp': m.timestamp.isoformat(),
-        'content': first_part.content,
-      }
-  raise UnexpectedModelBehavior(f'Unexpected message type for chat app: {m}')
-
-
-def get_messages_from_db(session: Session) -> list[ModelMessage]:
-  """Get all messages from database and convert back to ModelMessage objects"""
-  statement = select(ChatMessageDB)
-  results = session.exec(statement)
-  messages = []
+class StreamedChatMessage(ChatMessage):
+  """First event of a message streamed by `post_chat`, later events with the same `id` extend it."""
 
-  for db_message in results:
-    # Parse the JSON back to ModelMessage
-    message_data = json.loads(db_message.message_json)
+  id: str
 
-  return messages
 
+class ChatMessageDelta(TypedDict):
+  """Text to append to the streamed message `id`, `seq` counts up from 1 for each message."""
 
-def add_messages_to_db(session: Session, messages_json: str):
-  messages_data = json.loads(messages_json)
+  id: str
+  seq: int
+  delta: str
+  done: bool
+  # on the `done` event of a response that failed, e.g. couldn't be saved
+  error: NotRequired[str]
 
-  for message_data in messages_data:
-    db_message = ChatMessageDB(message_json=json.dumps(message_data))
-    session.add(db_message)
 
-  session.commit()
+def to_chat_message(m: ModelMessage) -> ChatMessage | None:
+  """The message as the chat UI shows it, `None` for messages with nothing to show, e.g. only tool calls."""
+  if isinstance(m, ModelRequest):
+    for part in m.parts:
+      if isinstance(part, UserPromptPart) and isinstance(part.content, str):
+        return {
+          'role': 'user',
+          'timestamp': part.timestamp.isoformat(),
+          'content': part.content,
+        }
+  else:
+    # reasoning models put a thinking part before the text
+    for part in m.parts:
+      if isinstance(part, TextPart):
+        return {
+          'role': 'model',
+          'timestamp': m.timestamp.isoformat(),
+          'content': part.content,
+        }
+  return None
+
+
+@dataclass
+class CachedConversation:
+  messages: list[ModelMessage]
+  # id of the row of each message, other workers may have added rows since
+  row_ids: list[int] = field(default_factory=list)
+  # held while topping up, so concurrent requests don't both append the same new rows
+  lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class ConversationCache:
+  """LRU of the message histories of recently active conversations."""
+
+  def __init__(self, max_conversations: int = 256) -> None:
+    self.max_conversations = max_conversations
+    self._conversations: OrderedDict[str, CachedConversation] = OrderedDict()
+
+  def get(self, conversation_id: str) -> CachedConversation | None:
+    conversation = self._conversations.get(conversation_id)
+    if conversation is not None:
+      self._conversations.move_to_end(conversation_id)
+    return conversation
+
+  def put(self, conversation_id: str, conversation: CachedConversation) -> None:
+    self._conversations[conversation_id] = conversation
+    self._conversations.move_to_end(conversation_id)
+    while len(self._conversations) > self.max_conversations:
+      self._conversations.popitem(last=False)
+
+
+recent_conversations = ConversationCache()
+
+
+def load_messages(rows: list[ChatMessageDB]) -> list[ModelMessage]:
+  # rows hold one message each, so join them into a JSON array and validate it in one pass
+  return ModelMessagesTypeAdapter.validate_json('[' + ','.join(row.message_json for row in rows) + ']')
+
+
+async def get_messages_from_db(session: AsyncSession, conversation_id: str) -> list[ModelMessage]:
+  """Get all messages of a conversation, from the cache of recent conversations when possible.
+
+  Other workers may have added messages since the conversation was cached, so only the rows from
+  the last `HISTORY_REREAD_ROWS` cached ones on are read, a short range of the conversation index.
+  Rows that committed late within that window are put back in id order.
+  """
+  await message_writer.wait_for(conversation_id)
+  cached = recent_conversations.get(conversation_id)
+  if cached is None:
+    cached = CachedConversation([])
+    recent_conversations.put(conversation_id, cached)
+
+  async with cached.lock:
+    reread_ids = cached.row_ids[-HISTORY_REREAD_ROWS:]
+    statement = select(ChatMessageDB).where(ChatMessageDB.conversation_id == conversation_id)
+    if reread_ids:
+      statement = statement.where(col(ChatMessageDB.id) >= reread_ids[0])
+    rows = list(await session.exec(statement.order_by(col(ChatMessageDB.id))))
+    row_ids = [row.id or 0 for row in rows]
+    # replaced rather than extended, runs in progress keep the history they started with
+    if row_ids[: len(reread_ids)] == reread_ids:
+      if len(rows) > len(reread_ids):
+        cached.messages = [*cached.messages, *load_messages(rows[len(reread_ids) :])]
+        cached.row_ids = [*cached.row_ids, *row_ids[len(reread_ids) :]]
+    else:
+      # a row committed late between cached ones, reload the window
+      keep = len(cached.row_ids) - len(reread_ids)
+      cached.messages = [*cached.messages[:keep], *load_messages(rows)]
+      cached.row_ids = [*cached.row_ids[:keep], *row_ids]
+  return cached.messages
+
+
+async def get_messages_page(
+  session: AsyncSession, conversation_id: str, before: int | None, limit: int
+) -> tuple[list[ModelMessage], int | None]:
+  """Get up to `limit` of the latest messages older than the id `before`, and the cursor for the previous page."""
+  await message_writer.wait_for(conversation_id)
+  statement = select(ChatMessageDB).where(ChatMessageDB.conversation_id == conversation_id)
+  if before is not None:
+    statement = statement.where(col(ChatMessageDB.id) < before)
+  rows = list(await session.exec(statement.order_by(col(ChatMessageDB.id).desc()).limit(limit)))
+  rows.reverse()
+  cursor = rows[0].id if len(rows) == limit else None
+  return load_messages(rows), cursor
+
+
+async def add_messages_to_db(conversation_id: str, messages: list[ModelMessage]):
+  """Queue messages for the group-committing writer and wait until they're committed.
+
+  Once this returns the messages are visible to every worker, so the next request of the
+  conversation can go anywhere.
+  """
+  await message_writer.add(conversation_id, messages)
 
 
 @app.get('/chat/')
-async def get_chat(session: SessionDep) -> Response:
-  messages = get_messages_from_db(session)
+async def get_chat(
+  session: SessionDep,
+  conversation_id: str = DEFAULT_CONVERSATION_ID,
+  before: int | None = None,
+  limit: Annotated[int, fastapi.Query(ge=1, le=500)] = 50,
+) -> Response:
+  messages, cursor = await get_messages_page(session, conversation_id, before, limit)
+  chat_messages = [chat_message for m in messages if (chat_message := to_chat_message(m)) is not None]
   return Response(
-    b'\n'.join(json.dumps(to_chat_message(m)).encode('utf-8') for m in messages),
+    b'\n'.join(json.dumps(m).encode('utf-8') for m in chat_messages),
     media_type='text/plain',
+    # pass as `before` to fetch the previous page, absent on the first page of the conversation
+    headers={'x-next-before': str(cursor)} if cursor is not None else None,
   )
 
 
-@app.post('/chat/')
-async def post_chat(prompt: Annotated[str, fastapi.Form()], session: SessionDep) -> StreamingResponse:
-  async def stream_messages():
-    """Streams new line delimited JSON `Message`s to the client."""
-    # stream the user prompt so that can be displayed straight away
-    yield (
-      json.dumps({
-        'role': 'user',
-        'timestamp': datetime.now(tz=UTC).isoformat(),
-        'content': prompt,
-      }).encode('utf-8')
-      + b'\n'
-    )
-
-    # get the chat history so far to pass as context to the agent
-    messages = get_messages_from_db(session)
-
+class StreamLog:
+  """Buffers the events of a stream and periodically queues them for the shared stream log."""
+
+  def __init__(self, stream_id: str) -> None:
+    self.stream_id = stream_id
+    self._rows: list[SQLModel] = []
+    self._flushed_at = time.monotonic()
+
+  def append(self, seq: int, event_json: str, done: bool = False) -> None:
+    self._rows.append(ChatStreamEventDB(stream_id=self.stream_id, seq=seq, event_json=event_json, done=done))
+    # the start is written straight away, so the stream can be resumed as soon as a client has seen it
+    if seq == 0 or done or time.monotonic() - self._flushed_at >= STREAM_FLUSH_INTERVAL:
+      self.flush()
+
+  def flush(self) -> None:
+    if self._rows:
+      message_writer.add_rows(self._rows)
+      self._rows = []
+    self._flushed_at = time.monotonic()
+
+
+async def read_stream_log(stream_id: str, after: int, before: int | None = None) -> AsyncIterator[ChatStreamEventDB]:
+  """Yield the logged events of a stream with `after < seq < before`, polling for events not written yet.
+
+  Stops after the `done` event, or if the stream hasn't been written to for `STREAM_STALL_TIMEOUT`.
+  """
+  last_event_at = time.monotonic()
+  while before is None or after + 1 < before:
+    async with AsyncSession(engine) as session:
+      statement = select(ChatStreamEventDB).where(
+        ChatStreamEventDB.stream_id == stream_id, col(ChatStreamEventDB.seq) > after
+      )
+      if before is not None:
+        statement = statement.where(col(ChatStreamEventDB.seq) < before)
+      rows = list(await session.exec(statement.order_by(col(ChatStreamEventDB.seq))))
+    for row in rows:
+      yield row
+      if row.done:
+        return
+    if rows:
+      after = rows[-1].seq
+      last_event_at = time.monotonic()
+    elif time.monotonic() - last_event_at > STREAM_STALL_TIMEOUT:
+      return
+    else:
+      await asyncio.sleep(STREAM_POLL_INTERVAL)
+
+
+class StreamBuffer:
+  """Ring buffer of the latest events of a stream generated by this worker.
+
+  Events are numbered by `seq` from 0, clients attach with the last `seq` they've seen and get
+  every event after it, then new ones as they're published, until the stream is done.
+  """
+
+  def __init__(self, stream_id: str, max_events: int = STREAM_BUFFER_EVENTS) -> None:
+    self.stream_id = stream_id
+    self.done = False
+    self._events: deque[tuple[int, bytes]] = deque(maxlen=max_events)
+    self._changed = asyncio.Event()
+
+  def publish(self, seq: int, event: bytes, done: bool = False) -> None:
+    self._events.append((seq, event))
+    self.done = done
+    # wake the current followers, later ones wait on a fresh event
+    self._changed.set()
+    self._changed = asyncio.Event()
+
+  async def follow(self, after: int) -> AsyncIterator[bytes]:
+    while True:
+      changed = self._changed
+      first_seq = self._events[0][0] if self._events else after + 1
+      if after + 1 < first_seq:
+        # the client is further behind than the buffer goes, what it missed is only in the stream log
+        async for row in read_stream_log(self.stream_id, after, before=first_seq):
+          yield row.event_json.encode('utf-8') + b'\n'
+          after = row.seq
+        if after + 1 < first_seq:
+          return
+        continue
+
+      # seqs are consecutive, so the next event is found by offset rather than by scanning
+      index = after + 1 - first_seq
+      if index < len(self._events):
+        after, event = self._events[index]
+        yield event
+      elif self.done:
+        return
+      else:
+        await changed.wait()
+
+
+# streams generated by this worker, finished ones stay for `STREAM_BUFFER_TTL`
+streams: dict[str, StreamBuffer] = {}
+
+
+async def generate(prompt: str, messages: list[ModelMessage], conversation_id: str, buffer: StreamBuffer):
+  """Run the agent, publishing its response to `buffer` and the stream log, then persist the new messages.
+
+  Runs as its own task, so the response is completed and saved even if the client disconnects.
+  """
+  stream_id = buffer.stream_id
+  log = StreamLog(stream_id)
+
+  def publish(seq: int, event: StreamedChatMessage | ChatMessageDelta, done: bool = False):
+    event_json = json.dumps(event)
+    buffer.publish(seq, event_json.encode('utf-8') + b'\n', done)
+    log.append(seq, event_json, done)
+
+  seq = 0
+  error: str | None = None
+  try:
     # run the agent with the user prompt and the chat history
-    async with agent.run_stream(prompt, message_history=messages) as result:
-      async for text in result.stream_output(debounce_by=0.01):
-        # text here is a `str` and the frontend wants
-        # JSON encoded ModelResponse, so we create one
-        m = ModelResponse(parts=[TextPart(text)], timestamp=result.timestamp())
-        yield json.dumps(to_chat_message(m)).encode('utf-8') + b'\n'
+    async with agent.run_stream(prompt, message_history=messages, deps=ChatDeps(conversation_id)) as result:
+      model_message: StreamedChatMessage = {
+        'id': stream_id,
+        'role': 'model',
+        'timestamp': result.timestamp().isoformat(),
+        'content': '',
+      }
+      publish(0, model_message)
+      async for text in result.stream_text(delta=True, debounce_by=0.01):
+        seq += 1
+        publish(seq, {'id': stream_id, 'seq': seq, 'delta': text, 'done': False})
+
+    # persist before sending `done`, so a client that saw it finds the messages on any worker
+    await add_messages_to_db(conversation_id, result.new_messages())
+  except Exception:
+    logfire.exception('Failed to generate response {stream_id}', stream_id=stream_id)
+    error = 'The response failed and was not saved, please try again.'
+  finally:
+    done_event: ChatMessageDelta = {'id': stream_id, 'seq': seq + 1, 'delta': '', 'done': True}
+    if error is not None:
+      done_event['error'] = error
+    publish(seq + 1, done_event, done=True)
+    asyncio.get_running_loop().call_later(STREAM_BUFFER_TTL, streams.pop, stream_id, None)
+
 
-    # add new messages to the database
-    add_messages_to_db(session, result.new_messages_json())
+@app.post('/chat/')
+async def post_chat(
+  prompt: Annotated[str, fastapi.Form()],
+  conversation_id: Annotated[str, fastapi.Form()] = DEFAULT_CONVERSATION_ID,
+) -> StreamingResponse:
+  # get the chat history so far to pass as context to the agent, in a session of its own that's
+  # closed before the response starts, a request session would hold a connection until it ends
+  async with AsyncSession(engine) as session:
+    messages = await get_messages_from_db(session, conversation_id)
+
+  buffer = StreamBuffer(uuid4().hex)
+  streams[buffer.stream_id] = buffer
+  task = asyncio.create_task(generate(prompt, messages, conversation_id, buffer))
+  generations.add(task)
+  task.add_done_callback(generations.discard)
+
+  async def stream_messages():
+    """Streams new line delimited JSON events to the client.
 
-  return StreamingResponse(stream_messages(), media_type='text/plain')
+    Each message is sent once in full as a `StreamedChatMessage`, model responses then only send
+    the new text as `ChatMessageDelta`s, so the bytes sent stay linear in the length of the answer.
+    The model message `id` is its stream id, to pass to `resume_stream` if the connection drops.
+    """
+    # stream the user prompt so that can be displayed straight away
+    user_message: StreamedChatMessage = {
+      'id': uuid4().hex,
+      'role': 'user',
+      'timestamp': datetime.now(tz=UTC).isoformat(),
+      'content': prompt,
+    }
+    yield json.dumps(user_message).encode('utf-8') + b'\n'
+    async for event in buffer.follow(-1):
+      yield event
+
+  return StreamingResponse(stream_messages(), media_type='application/x-ndjson')
+
+
+@app.get('/chat/streams/{stream_id}')
+async def resume_stream(stream_id: str, after: int = -1) -> StreamingResponse:
+  """Reattach to a model response stream, sending only the events after the `seq` `after`, until it's done.
+
+  The worker generating the stream serves it from memory, any other worker follows the shared stream log.
+  """
+  buffer = streams.get(stream_id)
+  if buffer is not None:
+    return StreamingResponse(buffer.follow(after), media_type='application/x-ndjson')
+
+  async with AsyncSession(engine) as session:
+    statement = select(ChatStreamEventDB.seq).where(ChatStreamEventDB.stream_id == stream_id).limit(1)
+    exists = (await session.exec(statement)).first() is not None
+  if not exists:
+    raise fastapi.HTTPException(status_code=404, detail='Unknown stream')
+
+  async def follow_stream_log():
+    async for row in read_stream_log(stream_id, after):
+      yield row.event_json.encode('utf-8') + b'\n'
+
+  return StreamingResponse(follow_stream_log(), media_type='application/x-ndjson')
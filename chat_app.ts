@@ -8,23 +8,24 @@ const convElement = document.getElementById("conversation");
 const promptInput = document.getElementById("prompt-input") as HTMLInputElement;
 const spinner = document.getElementById("spinner");
 
+// each browser keeps its own conversation, remembered across page loads
+let conversationId = localStorage.getItem("conversationId");
+if (!conversationId) {
+	conversationId = crypto.randomUUID();
+	localStorage.setItem("conversationId", conversationId);
+}
+
 // stream the response and render messages as each chunk is received
-// data is sent as newline-delimited JSON
+// data is sent as newline-delimited JSON, only complete lines are parsed, each of them once
 async function onFetchResponse(response: Response): Promise<void> {
-	let text = "";
-	const decoder = new TextDecoder();
 	if (response.ok) {
-		const reader = response.body.getReader();
-		while (true) {
-			const { done, value } = await reader.read();
-			if (done) {
-				break;
-			}
-			text += decoder.decode(value);
-			addMessages(text);
-			spinner.classList.remove("active");
+		try {
+			await readEvents(response);
+		} catch (error) {
+			// the connection dropped mid-answer, the server keeps generating so pick up where we left off
+			console.warn("Response interrupted, resuming", error);
+			await resumeStreams();
 		}
-		addMessages(text);
 		promptInput.disabled = false;
 		promptInput.focus();
 	} else {
@@ -37,40 +38,138 @@ async function onFetchResponse(response: Response): Promise<void> {
 	}
 }
 
+async function readEvents(response: Response): Promise<void> {
+	const decoder = new TextDecoder();
+	const reader = response.body.getReader();
+	let buffer = "";
+	while (true) {
+		const { done, value } = await reader.read();
+		if (done) {
+			break;
+		}
+		buffer += decoder.decode(value, { stream: true });
+		const lines = buffer.split("\n");
+		// the last line may be incomplete, keep it until the rest arrives
+		buffer = lines.pop();
+		addEvents(lines);
+		spinner.classList.remove("active");
+	}
+	addEvents([buffer + decoder.decode()]);
+}
+
+// any server can resume a stream, ask for the events after the last one received
+async function resumeStreams(attempts = 5): Promise<void> {
+	for (let attempt = 1; streamingMessages.size > 0; attempt++) {
+		const [id, message] = streamingMessages.entries().next().value;
+		try {
+			const response = await fetch(`/chat/streams/${id}?after=${message.seq}`);
+			if (response.status === 404) {
+				streamingMessages.delete(id);
+				continue;
+			}
+			await readEvents(response);
+			// the stream ended without `done`, the server generating it has gone away
+			streamingMessages.delete(id);
+		} catch (error) {
+			if (attempt >= attempts) {
+				throw error;
+			}
+			await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt));
+		}
+	}
+}
+
 // The format of messages, this matches pydantic-ai both for brevity and understanding
 // in production, you might not want to keep this format all the way to the frontend
 interface Message {
 	role: string;
 	content: string;
 	timestamp: string;
+	// set on messages streamed by POST /chat/, deltas refer to it
+	id?: string;
+}
+
+// text to append to the streamed message `id`, `seq` counts up from 1
+interface MessageDelta {
+	id: string;
+	seq: number;
+	delta: string;
+	done: boolean;
+	// set on the `done` event of a response that failed
+	error?: string;
+}
+
+interface StreamingMessage {
+	element: HTMLElement;
+	text: string;
+	seq: number;
 }
 
-// take raw response text and render messages into the `#conversation` element
-// Message timestamp is assumed to be a unique identifier of a message, and is used to deduplicate
-// hence you can send data about the same message multiple times, and it will be updated
-// instead of creating a new message elements
-function addMessages(responseText: string) {
-	const lines = responseText.split("\n");
-	const messages: Message[] = lines
-		.filter((line) => line.length > 1)
-		.map((j) => JSON.parse(j));
-	for (const message of messages) {
-		// we use the timestamp as a crude element id
-		const { timestamp, role, content } = message;
-		const id = `msg-${timestamp}`;
-		let msgDiv = document.getElementById(id);
-		if (!msgDiv) {
-			msgDiv = document.createElement("div");
-			msgDiv.id = id;
-			msgDiv.title = `${role} at ${timestamp}`;
-			msgDiv.classList.add("border-top", "pt-2", role);
-			convElement.appendChild(msgDiv);
+// model messages still being streamed, by message id
+const streamingMessages = new Map<string, StreamingMessage>();
+
+// render complete newline-delimited JSON lines into the `#conversation` element
+function addEvents(lines: string[]) {
+	for (const line of lines) {
+		if (line.length <= 1) {
+			continue;
+		}
+		const event: Message | MessageDelta = JSON.parse(line);
+		if ("delta" in event) {
+			addDelta(event);
+		} else {
+			addMessage(event);
 		}
-		msgDiv.innerHTML = marked.parse(content);
 	}
 	window.scrollTo({ top: document.body.scrollHeight, behavior: "smooth" });
 }
 
+// Message id, or for messages loaded from history the timestamp, is used as a unique identifier
+// of a message to deduplicate, hence the same message can be sent multiple times,
+// and it will be updated instead of creating a new message element
+function addMessage(message: Message) {
+	const { timestamp, role, content } = message;
+	const id = `msg-${message.id ?? timestamp}`;
+	let msgDiv = document.getElementById(id);
+	if (!msgDiv) {
+		msgDiv = document.createElement("div");
+		msgDiv.id = id;
+		msgDiv.title = `${role} at ${timestamp}`;
+		msgDiv.classList.add("border-top", "pt-2", role);
+		convElement.appendChild(msgDiv);
+	}
+	msgDiv.innerHTML = marked.parse(content);
+	if (role === "model" && message.id) {
+		msgDiv.classList.add("streaming");
+		streamingMessages.set(message.id, { element: msgDiv, text: content, seq: 0 });
+	}
+}
+
+// while a message streams, deltas are appended as plain text so each chunk costs O(chunk),
+// the markdown is rendered once, when the message is done
+function addDelta(event: MessageDelta) {
+	const message = streamingMessages.get(event.id);
+	if (!message) {
+		console.warn(`Delta for unknown message ${event.id}`, event);
+		return;
+	}
+	if (event.seq !== message.seq + 1) {
+		console.warn(`Message ${event.id} expected seq ${message.seq + 1}, got ${event.seq}`);
+	}
+	message.seq = event.seq;
+	message.text += event.delta;
+	if (event.done) {
+		message.element.classList.remove("streaming");
+		message.element.innerHTML = marked.parse(message.text);
+		streamingMessages.delete(event.id);
+		if (event.error) {
+			onError(event.error);
+		}
+	} else {
+		message.element.append(event.delta);
+	}
+}
+
 function onError(error: any) {
 	console.error(error);
 	document.getElementById("error").classList.remove("d-none");
@@ -81,6 +180,7 @@ async function onSubmit(e: SubmitEvent): Promise<void> {
 	e.preventDefault();
 	spinner.classList.add("active");
 	const body = new FormData(e.target as HTMLFormElement);
+	body.set("conversation_id", conversationId);
 
 	promptInput.value = "";
 	promptInput.disabled = true;
@@ -94,5 +194,7 @@ document
 	.querySelector("form")
 	.addEventListener("submit", (e) => onSubmit(e).catch(onError));
 
-// load messages on page load
-fetch("/chat/").then(onFetchResponse).catch(onError);
+// load the latest messages of the conversation on page load
+fetch(`/chat/?conversation_id=${encodeURIComponent(conversationId)}`)
+	.then(onFetchResponse)
+	.catch(onError);
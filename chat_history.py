@@ -0,0 +1,78 @@
+from __future__ import annotations as _annotations
+
+from collections.abc import Sequence
+
+from pydantic_ai import Agent, RunContext
+from pydantic_ai.messages import (
+  ModelMessage,
+  ModelRequest,
+  ModelResponse,
+  TextPart,
+  ToolCallPart,
+  UserPromptPart,
+)
+
+from constant import model
+
+summary_agent = Agent(
+  model=model,
+  instructions=(
+    'You maintain a running summary of a conversation between a user and an assistant. '
+    'Update the previous summary with the new messages, keeping facts, decisions, names and open questions '
+    'the assistant needs to continue the conversation. Reply with the summary only.'
+  ),
+)
+
+
+def estimate_tokens(message: ModelMessage) -> int:
+  """Approximate token count of a message, ~4 characters per token plus per-message overhead."""
+  if isinstance(message, ModelResponse) and message.usage.output_tokens:
+    return message.usage.output_tokens
+
+  chars = 0
+  for part in message.parts:
+    if isinstance(part, ToolCallPart):
+      chars += len(part.tool_name) + len(part.args_as_json_str())
+    else:
+      content = getattr(part, 'content', '')
+      chars += len(content) if isinstance(content, str) else len(str(content))
+  return chars // 4 + 4
+
+
+def is_turn_start(message: ModelMessage) -> bool:
+  return isinstance(message, ModelRequest) and any(isinstance(part, UserPromptPart) for part in message.parts)
+
+
+def window_start(messages: Sequence[ModelMessage], token_budget: int) -> int:
+  """Index of the first message of the most recent whole turns that fit in `token_budget`.
+
+  Windows always start at a user prompt so tool calls are never separated from their returns,
+  and the latest turn is kept even if it alone exceeds the budget.
+  """
+  start = None
+  total = 0
+  for i in range(len(messages) - 1, -1, -1):
+    total += estimate_tokens(messages[i])
+    if total > token_budget and start is not None:
+      break
+    if is_turn_start(messages[i]):
+      start = i
+  return start or 0
+
+
+def render_transcript(messages: Sequence[ModelMessage]) -> str:
+  lines: list[str] = []
+  for message in messages:
+    for part in message.parts:
+      if isinstance(part, UserPromptPart) and isinstance(part.content, str):
+        lines.append(f'User: {part.content}')
+      elif isinstance(part, TextPart):
+        lines.append(f'Assistant: {part.content}')
+  return '\n\n'.join(lines)
+
+
+async def summarize(ctx: RunContext[object], previous: str | None, messages: Sequence[ModelMessage]) -> str:
+  """Fold `messages` into the `previous` summary, counting the request towards the parent run's usage."""
+  prompt = f'Previous summary:\n{previous or "(none)"}\n\nNew messages:\n{render_transcript(messages)}'
+  result = await summary_agent.run(prompt, usage=ctx.usage)
+  return result.output
@@ -0,0 +1,154 @@
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+from pathlib import Path
+from uuid import uuid4
+
+import httpx
+from pydantic_ai.messages import ModelMessage
+from pydantic_ai.models.function import AgentInfo, DeltaToolCalls, FunctionModel
+
+import chat_app
+
+# Load test of `chat_app` with several uvicorn workers, reporting time-to-first-token percentiles, e.g.
+#   python chat_load_test.py --workers 1 2 4 --concurrency 32 --requests 256 --fake-model
+# each worker count gets a fresh server and database, `--fake-model` replaces the LLM with one streaming
+# canned text at a fixed latency, to measure the server rather than the model
+FAKE_MODEL_ENV = 'CHAT_LOAD_TEST_FAKE_MODEL'
+
+
+async def fake_stream(_messages: list[ModelMessage], _info: AgentInfo) -> AsyncIterator[str | DeltaToolCalls]:
+  first_token_latency, token_latency = (float(v) for v in os.environ[FAKE_MODEL_ENV].split(','))
+  await asyncio.sleep(first_token_latency)
+  for i in range(50):
+    yield f'token{i} '
+    await asyncio.sleep(token_latency)
+
+
+if os.getenv(FAKE_MODEL_ENV):
+  chat_app.agent.model = FunctionModel(stream_function=fake_stream)
+
+# served by the workers of the load test, so the fake model applies to them too
+app = chat_app.app
+
+
+@dataclass
+class RunStats:
+  workers: int
+  ttfts: list[float] = field(default_factory=list)
+  durations: list[float] = field(default_factory=list)
+  errors: int = 0
+  elapsed: float = 0.0
+
+  def percentile(self, values: list[float], p: int) -> float:
+    if len(values) < 2:
+      return values[0] if values else float('nan')
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1]
+
+  def report(self) -> str:
+    ttft_p50 = self.percentile(self.ttfts, 50) * 1000
+    ttft_p99 = self.percentile(self.ttfts, 99) * 1000
+    total_p50 = self.percentile(self.durations, 50) * 1000
+    throughput = len(self.durations) / self.elapsed if self.elapsed else 0.0
+    return (
+      f'{self.workers:>7} {ttft_p50:>10.1f} {ttft_p99:>10.1f} {total_p50:>11.1f} {throughput:>9.1f} {self.errors:>6}'
+    )
+
+
+async def chat(client: httpx.AsyncClient, conversation_id: str, stats: RunStats) -> None:
+  start = time.perf_counter()
+  ttft = None
+  try:
+    data = {'prompt': 'Tell me about horizontal scaling.', 'conversation_id': conversation_id}
+    async with client.stream('POST', '/chat/', data=data) as response:
+      response.raise_for_status()
+      async for line in response.aiter_lines():
+        if ttft is None and line and json.loads(line).get('delta'):
+          ttft = time.perf_counter() - start
+  except httpx.HTTPError:
+    stats.errors += 1
+    return
+  if ttft is None:
+    stats.errors += 1
+    return
+  stats.ttfts.append(ttft)
+  stats.durations.append(time.perf_counter() - start)
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float = 30) -> None:
+  deadline = time.monotonic() + timeout
+  while True:
+    try:
+      if (await client.get('/')).status_code == 200:
+        return
+    except httpx.TransportError:
+      if time.monotonic() > deadline:
+        raise
+    await asyncio.sleep(0.2)
+
+
+async def run(workers: int, args: argparse.Namespace) -> RunStats:
+  with tempfile.TemporaryDirectory() as tmp:
+    env = dict(os.environ)
+    env.setdefault('CHAT_DATABASE_URL', f'sqlite+aiosqlite:///{Path(tmp) / "database.db"}')
+    if args.fake_model:
+      env[FAKE_MODEL_ENV] = f'{args.first_token_latency},{args.token_latency}'
+    server = subprocess.Popen(
+      [sys.executable, '-m', 'uvicorn', 'chat_load_test:app', '--port', str(args.port), '--workers', str(workers)],
+      env=env,
+      cwd=Path(__file__).parent,
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL,
+    )
+    try:
+      limits = httpx.Limits(max_connections=args.concurrency)
+      timeout = httpx.Timeout(120)
+      async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{args.port}', limits=limits, timeout=timeout) as client:
+        await wait_until_ready(client)
+        stats = RunStats(workers)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        # a conversation per client, so history doesn't grow with the number of requests
+        conversations = [uuid4().hex for _ in range(args.concurrency)]
+
+        async def one(i: int) -> None:
+          async with semaphore:
+            await chat(client, conversations[i % len(conversations)], stats)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        stats.elapsed = time.perf_counter() - start
+        return stats
+    finally:
+      server.terminate()
+      server.wait()
+
+
+async def main() -> None:
+  parser = argparse.ArgumentParser(description='Load test chat_app with several uvicorn workers')
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+  parser.add_argument('--concurrency', type=int, default=32)
+  parser.add_argument('--requests', type=int, default=256)
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--fake-model', action='store_true')
+  parser.add_argument('--first-token-latency', type=float, default=0.05)
+  parser.add_argument('--token-latency', type=float, default=0.005)
+  args = parser.parse_args()
+
+  print(f'{"workers":>7} {"ttft p50":>10} {"ttft p99":>10} {"total p50":>11} {"req/s":>9} {"errors":>6}')
+  for workers in args.workers:
+    stats = await run(workers, args)
+    print(stats.report())
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
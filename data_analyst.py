@@ -1,29 +1,66 @@
+import hashlib
+import re
 from dataclasses import dataclass, field
 
 import datasets
 import duckdb
-import pandas as pd
+import pyarrow as pa
 from byeprint import p
 from pydantic_ai import Agent, ModelRetry, RunContext
 
 from constant import model
+from result_store import DuckDBTable, ResultStore, Value
+
+ANALYST_DATABASE_FILE = 'data_analyst.duckdb'
+CATALOG_SQL = """
+CREATE TABLE IF NOT EXISTS analyst_datasets (
+    path VARCHAR,
+    split VARCHAR,
+    table_name VARCHAR NOT NULL,
+    version VARCHAR,
+    config_hash VARCHAR,
+    description VARCHAR,
+    features VARCHAR,
+    loaded_at TIMESTAMP DEFAULT current_timestamp,
+    PRIMARY KEY (path, split)
+);
+CREATE TABLE IF NOT EXISTS analyst_query_cache (
+    key VARCHAR PRIMARY KEY,
+    sql VARCHAR NOT NULL,
+    input_fingerprint VARCHAR NOT NULL,
+    table_name VARCHAR NOT NULL,
+    created_at TIMESTAMP DEFAULT current_timestamp
+);
+"""
 
 
 @dataclass
 class AnalystAgentDeps:
-  output: dict[str, pd.DataFrame] = field(default_factory=dict)
-
-  def store(self, value: pd.DataFrame) -> str:
+  # cold outputs are spilled to disk once their total size is over the store's memory budget
+  output: ResultStore = field(default_factory=ResultStore)
+  # DuckDB database file that keeps loaded datasets and query results across sessions, if any
+  database: str | None = None
+  # what each output was computed from, so identical queries over identical inputs can be reused
+  fingerprints: dict[str, str] = field(default_factory=dict)
+  conn: duckdb.DuckDBPyConnection | None = field(default=None, init=False)
+
+  def __post_init__(self):
+    if self.database is not None:
+      self.conn = duckdb.connect(self.database)
+      self.conn.execute(CATALOG_SQL)
+
+  def store(self, value: Value, fingerprint: str, memory_mapped: bool = False) -> str:
     """Store the output in deps and return the reference such as Out[1] to be used by the LLM."""
-    ref = f'Out[{len(self.output) + 1}]'
+    ref = self.output.add(value, memory_mapped)
+    self.fingerprints[ref] = fingerprint
     p(ref)
-    self.output[ref] = value
     return ref
 
-  def get(self, ref: str) -> pd.DataFrame:
-    if ref not in self.output:
+  def get(self, ref: str) -> Value:
+    value = self.output.get(ref)
+    if value is None:
       raise ModelRetry(f'Error: {ref} is not a valid variable reference. Check the previous messages and try again.')
-    return self.output[ref]
+    return value
 
 
 analyst_agent = Agent(
@@ -33,6 +70,35 @@ analyst_agent = Agent(
 )
 
 
+def catalog_table_name(path: str, split: str) -> str:
+  return re.sub(r'\W+', '_', f'{path}_{split}').lower()
+
+
+def dataset_fingerprint(path: str, split: str, version: str | None, config_hash: str | None) -> str:
+  return f'{path}:{split}:{version}:{config_hash}'
+
+
+def query_fingerprint(sql: str, input_fingerprint: str) -> str:
+  return hashlib.sha256(f'{input_fingerprint}\0{sql.strip()}'.encode()).hexdigest()
+
+
+def bind_dataset(conn: duckdb.DuckDBPyConnection, value: Value) -> None:
+  """Make `value` queryable as `dataset`, without copying it."""
+  if isinstance(value, DuckDBTable):
+    conn.execute(f'CREATE OR REPLACE TEMP VIEW dataset AS SELECT * FROM "{value.name}"')
+  else:
+    conn.register('dataset', value)
+
+
+def describe_loaded(ref: str, description: str | None, features: str | None) -> str:
+  output = [
+    f'Loaded the dataset as `{ref}`.',
+    f'Description: {description}' if description else None,
+    f'Features: {features}' if features else None,
+  ]
+  return '\n'.join(filter(None, output))
+
+
 @analyst_agent.tool
 def load_dataset(
   ctx: RunContext[AnalystAgentDeps],
@@ -46,6 +112,23 @@ def load_dataset(
       path: name of the dataset in the form of `<user_name>/<dataset_name>`
       split: load the split of the dataset (default: "train")
   """
+  conn = ctx.deps.conn
+  if conn is not None:
+    # loaded in an earlier session, no need to resolve, download or convert it again
+    row = (
+      conn.cursor()
+      .execute(
+        'SELECT table_name, version, config_hash, description, features FROM analyst_datasets '
+        'WHERE path = ? AND split = ?',
+        [path, split],
+      )
+      .fetchone()
+    )
+    if row is not None:
+      table_name, version, config_hash, description, features = row
+      ref = ctx.deps.store(DuckDBTable(table_name), dataset_fingerprint(path, split, version, config_hash))
+      return describe_loaded(ref, description, features)
+
   builder = datasets.load_dataset_builder(path)  # pyright: ignore[reportUnknownMemberType]
   p(builder)
   splits: dict[str, datasets.SplitInfo] = builder.info.splits or {}  # pyright: ignore[reportUnknownMemberType]
@@ -57,44 +140,88 @@ def load_dataset(
   dataset = builder.as_dataset(split=split)
   p(dataset)
   assert isinstance(dataset, datasets.Dataset)
-  dataframe = dataset.to_pandas()
-  assert isinstance(dataframe, pd.DataFrame)
-  ref = ctx.deps.store(dataframe)
-  p(ref)
-  output = [
-    f'Loaded the dataset as `{ref}`.',
-    f'Description: {dataset.info.description}' if dataset.info.description else None,
-    f'Features: {dataset.info.features!r}' if dataset.info.features else None,
-  ]
-  return '\n'.join(filter(None, output))
+  # a zero-copy view of the memory-mapped Arrow files in the HF cache
+  table = dataset.with_format('arrow')[:]
+  assert isinstance(table, pa.Table)
+  version = str(builder.info.version) if builder.info.version else None
+  fingerprint = dataset_fingerprint(path, split, version, builder.hash)
+  description = dataset.info.description or None
+  features = repr(dataset.info.features) if dataset.info.features else None
+
+  if conn is None:
+    ref = ctx.deps.store(table, fingerprint, memory_mapped=True)
+  else:
+    # converted to DuckDB's storage once, later sessions query it straight from the database file
+    table_name = catalog_table_name(path, split)
+    cursor = conn.cursor()
+    cursor.register('arrow_dataset', table)
+    cursor.begin()
+    cursor.execute(f'CREATE OR REPLACE TABLE "{table_name}" AS SELECT * FROM arrow_dataset')
+    cursor.execute(
+      'INSERT OR REPLACE INTO analyst_datasets (path, split, table_name, version, config_hash, description, features) '
+      'VALUES (?, ?, ?, ?, ?, ?, ?)',
+      [path, split, table_name, version, builder.hash, description, features],
+    )
+    cursor.commit()
+    ref = ctx.deps.store(DuckDBTable(table_name), fingerprint)
+  return describe_loaded(ref, description, features)
 
 
 @analyst_agent.tool
 def run_duckdb(ctx: RunContext[AnalystAgentDeps], dataset: str, sql: str) -> str:
-  """Run DuckDB SQL query on the DataFrame.
+  """Run DuckDB SQL query on the dataset.
 
   Note that the virtual table name used in DuckDB SQL must be `dataset`.
 
   Args:
       ctx: Pydantic AI agent RunContext
-      dataset: reference string to the DataFrame
+      dataset: reference string to the dataset
       sql: the query to be executed using DuckDB
   """
   data = ctx.deps.get(dataset)
-  result = duckdb.query_df(df=data, virtual_table_name='dataset', sql_query=sql)
-  ref = ctx.deps.store(result.df())  # pyright: ignore[reportUnknownMemberType]
+  fingerprint = query_fingerprint(sql, ctx.deps.fingerprints[dataset])
+  if ctx.deps.conn is None:
+    # DuckDB scans the Arrow buffers in place and returns Arrow, nothing goes through pandas
+    with duckdb.connect() as conn:
+      bind_dataset(conn, data)
+      result = conn.execute(sql).to_arrow_table()
+    ref = ctx.deps.store(result, fingerprint)
+    return f'Executed SQL, result is `{ref}`'
+
+  cursor = ctx.deps.conn.cursor()
+  row = cursor.execute('SELECT table_name FROM analyst_query_cache WHERE key = ?', [fingerprint]).fetchone()
+  if row is not None:
+    ref = ctx.deps.store(DuckDBTable(row[0]), fingerprint)
+    return f'Executed SQL, result is `{ref}` (cached from an earlier run of the same query)'
+
+  table_name = f'query_result_{fingerprint[:16]}'
+  bind_dataset(cursor, data)
+  cursor.begin()
+  cursor.execute(f'CREATE OR REPLACE TABLE "{table_name}" AS {sql.strip().rstrip(";")}')
+  cursor.execute(
+    'INSERT OR REPLACE INTO analyst_query_cache (key, sql, input_fingerprint, table_name) VALUES (?, ?, ?, ?)',
+    [fingerprint, sql, ctx.deps.fingerprints[dataset], table_name],
+  )
+  cursor.commit()
+  ref = ctx.deps.store(DuckDBTable(table_name), fingerprint)
   return f'Executed SQL, result is `{ref}`'
 
 
 @analyst_agent.tool
 def display(ctx: RunContext[AnalystAgentDeps], name: str) -> str:
-  """Display at most 5 rows of the dataframe."""
+  """Display at most 5 rows of the dataset."""
   dataset = ctx.deps.get(name)
-  return dataset.head().to_string()  # pyright: ignore[reportUnknownMemberType]
+  # only the preview is converted to pandas, for its readable formatting
+  if isinstance(dataset, DuckDBTable):
+    assert ctx.deps.conn is not None
+    preview = ctx.deps.conn.cursor().execute(f'SELECT * FROM "{dataset.name}" LIMIT 5').df()
+  else:
+    preview = dataset.slice(0, 5).to_pandas()
+  return preview.to_string()
 
 
 if __name__ == '__main__':
-  deps = AnalystAgentDeps()
+  deps = AnalystAgentDeps(database=ANALYST_DATABASE_FILE)
   result = analyst_agent.run_sync(
     user_prompt='Load the dataset `cornell-movie-review-data/rotten_tomatoes`',
     deps=deps,
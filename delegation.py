@@ -0,0 +1,119 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import weakref
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import TypeVar
+
+from pydantic_ai import Agent, RunUsage, UsageLimits
+from pydantic_ai.exceptions import UsageLimitExceeded
+from pydantic_ai.messages import ModelMessage, ModelResponse
+from pydantic_ai.models import Model, ModelRequestParameters, infer_model
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.settings import ModelSettings
+
+DepsT = TypeVar('DepsT')
+OutputT = TypeVar('OutputT')
+ItemT = TypeVar('ItemT')
+
+
+@dataclass
+class _InFlight:
+  requests: int = 0
+
+
+# requests in flight per shared `RunUsage`, keyed by id since it isn't hashable, entries are
+# dropped when the usage is garbage collected
+_in_flight: dict[int, _InFlight] = {}
+
+
+def _in_flight_for(usage: RunUsage) -> _InFlight:
+  in_flight = _in_flight.get(id(usage))
+  if in_flight is None:
+    in_flight = _in_flight[id(usage)] = _InFlight()
+    weakref.finalize(usage, _in_flight.pop, id(usage), None)
+  return in_flight
+
+
+class _RequestBudgetModel(WrapperModel):
+  """Counts requests in flight against the request limit, since `UsageLimits` only sees them once answered.
+
+  Without it, concurrent runs all pass the check before any of them is counted and overshoot the limit.
+  The count is kept per usage, so concurrent `fan_out` calls charging the same usage see each other's.
+  """
+
+  def __init__(self, wrapped: Model, usage: RunUsage, request_limit: int) -> None:
+    super().__init__(wrapped)
+    self.usage = usage
+    self.request_limit = request_limit
+    self.in_flight = _in_flight_for(usage)
+
+  async def request(
+    self,
+    messages: list[ModelMessage],
+    model_settings: ModelSettings | None,
+    model_request_parameters: ModelRequestParameters,
+  ) -> ModelResponse:
+    if self.usage.requests + self.in_flight.requests >= self.request_limit:
+      raise UsageLimitExceeded(f'The next request would exceed the request_limit of {self.request_limit}')
+    self.in_flight.requests += 1
+    try:
+      return await super().request(messages, model_settings, model_request_parameters)
+    finally:
+      self.in_flight.requests -= 1
+
+
+def split_count(total: int, max_per_run: int) -> list[int]:
+  """Split `total` items into as few runs of at most `max_per_run` as possible, as evenly as possible."""
+  if total <= 0:
+    return []
+  runs = -(-total // max_per_run)
+  base, extra = divmod(total, runs)
+  return [base + 1] * extra + [base] * (runs - extra)
+
+
+async def fan_out(
+  agent: Agent[DepsT, OutputT],
+  prompts: Sequence[str],
+  *,
+  usage: RunUsage,
+  usage_limits: UsageLimits | None = None,
+  deps: DepsT = None,
+  max_concurrency: int = 4,
+) -> list[OutputT]:
+  """Run `agent` once per prompt, at most `max_concurrency` at a time, returning the outputs in prompt order.
+
+  Pass the parent's `ctx.usage` and its `UsageLimits`, so every run counts towards and is limited by
+  the parent's budget. Runs share the event loop, so updating the usage needs no lock. Requests in
+  flight are counted against the request limit, token limits can only be checked between requests.
+  As soon as one run fails, e.g. with `UsageLimitExceeded` once the budget is spent, the others are
+  cancelled and the error is raised.
+  """
+  if not prompts:
+    return []
+  model: Model | None = None
+  if usage_limits is not None and usage_limits.request_limit is not None:
+    if agent.model is None:
+      raise ValueError('the agent needs a model to limit its requests')
+    model = _RequestBudgetModel(infer_model(agent.model), usage, usage_limits.request_limit)
+  semaphore = asyncio.Semaphore(max_concurrency)
+
+  async def run(prompt: str) -> OutputT:
+    async with semaphore:
+      result = await agent.run(prompt, deps=deps, model=model, usage=usage, usage_limits=usage_limits)
+      return result.output
+
+  tasks = [asyncio.create_task(run(prompt)) for prompt in prompts]
+  try:
+    return await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    raise
+
+
+def merge_lists(outputs: Sequence[Sequence[ItemT]]) -> list[ItemT]:
+  """Merge list outputs of `fan_out`, dropping duplicates that different runs came up with."""
+  return list(dict.fromkeys(item for output in outputs for item in output))
@@ -0,0 +1,256 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import base64
+import hashlib
+import sqlite3
+import threading
+import time
+from collections.abc import Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TypeAlias
+
+import logfire
+import numpy as np
+import numpy.typing as npt
+from openai import AsyncOpenAI
+
+EMBEDDING_MODEL = 'llama-3.2-3b-instruct'
+
+Vector: TypeAlias = npt.NDArray[np.float32]
+
+
+@dataclass
+class EmbeddingStats:
+  """Throughput and latency counters for an `EmbeddingService`."""
+
+  requests: int = 0
+  inputs: int = 0
+  total_latency: float = 0.0
+  max_latency: float = 0.0
+  max_batch_size: int = 0
+  coalesced_batches: int = 0
+
+  def record(self, batch_size: int, latency: float) -> None:
+    self.requests += 1
+    self.inputs += batch_size
+    self.total_latency += latency
+    self.max_latency = max(self.max_latency, latency)
+    self.max_batch_size = max(self.max_batch_size, batch_size)
+
+  @property
+  def mean_latency(self) -> float:
+    return self.total_latency / self.requests if self.requests else 0.0
+
+  @property
+  def mean_batch_size(self) -> float:
+    return self.inputs / self.requests if self.requests else 0.0
+
+  @property
+  def inputs_per_second(self) -> float:
+    return self.inputs / self.total_latency if self.total_latency else 0.0
+
+
+@dataclass
+class CacheStats:
+  hits: int = 0
+  misses: int = 0
+  evictions: int = 0
+
+  @property
+  def hit_rate(self) -> float:
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups else 0.0
+
+
+class EmbeddingCache:
+  """On-disk embedding cache keyed by model name and text hash.
+
+  Vectors are stored as raw float32 blobs in SQLite. Once the cache holds more than
+  `max_entries` vectors, the least recently used ones are evicted.
+  """
+
+  def __init__(self, path: str | Path, max_entries: int = 100_000) -> None:
+    self.max_entries = max_entries
+    self.stats = CacheStats()
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    self._conn.executescript(
+      """
+      PRAGMA journal_mode = WAL;
+      CREATE TABLE IF NOT EXISTS embeddings (
+          key TEXT PRIMARY KEY,
+          vector BLOB NOT NULL,
+          last_used REAL NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used);
+      """
+    )
+
+  @staticmethod
+  def key(model: str, text: str) -> str:
+    return hashlib.sha256(f'{model}\0{text}'.encode()).hexdigest()
+
+  async def get_many(self, model: str, texts: Sequence[str]) -> list[Vector | None]:
+    return await asyncio.to_thread(self._get_many, [self.key(model, text) for text in texts])
+
+  async def put_many(self, model: str, texts: Sequence[str], embeddings: Sequence[Vector]) -> None:
+    await asyncio.to_thread(self._put_many, [self.key(model, text) for text in texts], embeddings)
+
+  def close(self) -> None:
+    self._conn.close()
+
+  def _get_many(self, keys: list[str]) -> list[Vector | None]:
+    found: dict[str, bytes] = {}
+    with self._lock, self._conn:
+      # stay well under SQLite's bound parameter limit
+      for i in range(0, len(keys), 500):
+        chunk = keys[i : i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        rows = self._conn.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk)
+        found.update(rows)
+        self._conn.execute(f'UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})', (time.time(), *chunk))
+
+    results: list[Vector | None] = []
+    for key in keys:
+      blob = found.get(key)
+      if blob is None:
+        self.stats.misses += 1
+        results.append(None)
+      else:
+        self.stats.hits += 1
+        results.append(np.frombuffer(blob, dtype=np.float32))
+    return results
+
+  def _put_many(self, keys: list[str], embeddings: Sequence[Vector]) -> None:
+    now = time.time()
+    with self._lock, self._conn:
+      self._conn.executemany(
+        'INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)',
+        [(key, embedding.astype(np.float32, copy=False).tobytes(), now) for key, embedding in zip(keys, embeddings)],
+      )
+      (count,) = self._conn.execute('SELECT count(*) FROM embeddings').fetchone()
+      if count > self.max_entries:
+        evicted = self._conn.execute(
+          'DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+          (count - self.max_entries,),
+        ).rowcount
+        self.stats.evictions += evicted
+
+
+class EmbeddingService:
+  """Non-blocking embedding client on top of `AsyncOpenAI`.
+
+  `embed_many` splits large inputs into batches sent concurrently, while `embed`
+  coalesces single texts requested within `coalesce_window` seconds of each other
+  into one HTTP call. With a `cache`, only texts missing from it reach the endpoint.
+  """
+
+  def __init__(
+    self,
+    openai: AsyncOpenAI,
+    model: str = EMBEDDING_MODEL,
+    *,
+    max_batch_size: int = 128,
+    max_concurrency: int = 4,
+    coalesce_window: float = 0.005,
+    cache: EmbeddingCache | None = None,
+  ) -> None:
+    self.openai = openai
+    self.model = model
+    self.cache = cache
+    self.max_batch_size = max_batch_size
+    self.coalesce_window = coalesce_window
+    self.stats = EmbeddingStats()
+    self._sem = asyncio.Semaphore(max_concurrency)
+    self._pending: list[tuple[str, asyncio.Future[Vector]]] = []
+    self._flush_handle: asyncio.TimerHandle | None = None
+    self._tasks: set[asyncio.Task[None]] = set()
+
+  async def embed(self, text: str) -> Vector:
+    """Embed a single text, sharing the HTTP call with concurrent callers."""
+    if self.cache is not None:
+      (cached,) = await self.cache.get_many(self.model, [text])
+      if cached is not None:
+        return cached
+
+    loop = asyncio.get_running_loop()
+    future: asyncio.Future[Vector] = loop.create_future()
+    self._pending.append((text, future))
+    if len(self._pending) >= self.max_batch_size:
+      self._flush()
+    elif self._flush_handle is None:
+      self._flush_handle = loop.call_later(self.coalesce_window, self._flush)
+    embedding = await future
+    if self.cache is not None:
+      await self.cache.put_many(self.model, [text], [embedding])
+    return embedding
+
+  async def aclose(self) -> None:
+    """Embed the texts still waiting to be coalesced, then close the cache."""
+    self._flush()
+    if self._tasks:
+      await asyncio.wait(set(self._tasks))
+    if self.cache is not None:
+      self.cache.close()
+
+  async def embed_many(self, texts: Sequence[str]) -> list[Vector]:
+    """Embed many texts, `max_batch_size` inputs per request."""
+    if self.cache is None:
+      return await self._embed_many(texts)
+
+    results = await self.cache.get_many(self.model, texts)
+    missing = [i for i, embedding in enumerate(results) if embedding is None]
+    if missing:
+      missing_texts = [texts[i] for i in missing]
+      embeddings = await self._embed_many(missing_texts)
+      await self.cache.put_many(self.model, missing_texts, embeddings)
+      for i, embedding in zip(missing, embeddings):
+        results[i] = embedding
+    return results  # pyright: ignore[reportReturnType]
+
+  async def _embed_many(self, texts: Sequence[str]) -> list[Vector]:
+    batches = [texts[i : i + self.max_batch_size] for i in range(0, len(texts), self.max_batch_size)]
+    results = await asyncio.gather(*(self._create(batch) for batch in batches))
+    return [embedding for batch in results for embedding in batch]
+
+  def _flush(self) -> None:
+    if self._flush_handle is not None:
+      self._flush_handle.cancel()
+      self._flush_handle = None
+    pending, self._pending = self._pending, []
+    if pending:
+      self.stats.coalesced_batches += 1
+      task = asyncio.create_task(self._resolve(pending))
+      self._tasks.add(task)
+      task.add_done_callback(self._tasks.discard)
+
+  async def _resolve(self, pending: list[tuple[str, asyncio.Future[Vector]]]) -> None:
+    try:
+      embeddings = await self._create([text for text, _ in pending])
+    except Exception as e:
+      for _, future in pending:
+        if not future.done():
+          future.set_exception(e)
+    else:
+      for (_, future), embedding in zip(pending, embeddings):
+        if not future.done():
+          future.set_result(embedding)
+
+  async def _create(self, texts: Sequence[str]) -> list[Vector]:
+    async with self._sem:
+      with logfire.span('create {batch_size} embeddings', batch_size=len(texts)):
+        start = time.perf_counter()
+        # base64 responses are raw little-endian float32, so no JSON float parsing is needed
+        response = await self.openai.embeddings.create(input=list(texts), model=self.model, encoding_format='base64')
+        self.stats.record(len(texts), time.perf_counter() - start)
+
+    assert len(response.data) == len(texts), f'Expected {len(texts)} embeddings, got {len(response.data)}'
+    return [decode_embedding(item.embedding) for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def decode_embedding(embedding: str | list[float]) -> Vector:
+  if isinstance(embedding, str):
+    return np.frombuffer(base64.b64decode(embedding), dtype='<f4').astype(np.float32, copy=False)
+  return np.asarray(embedding, dtype=np.float32)
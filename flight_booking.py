@@ -1,6 +1,10 @@
 import asyncio
 import datetime
-from dataclasses import dataclass
+import hashlib
+import re
+from collections import defaultdict
+from collections.abc import Iterable
+from dataclasses import dataclass, field
 from typing import Literal
 
 import logfire
@@ -12,6 +16,10 @@ from pydantic_ai.providers.ollama import OllamaProvider
 from rich.prompt import Prompt
 
 model = OpenAIChatModel(model_name='gpt-oss:20b', provider=OllamaProvider(base_url='http://localhost:11434/v1'))
+# pages longer than this are split into chunks of whole records, which are extracted concurrently
+MAX_EXTRACTION_CHUNK_CHARS = 4000
+# extraction requests in flight at once per page, so a long page doesn't flood the local model server
+MAX_EXTRACTION_CONCURRENCY = 4
 
 
 class FlightDetails(BaseModel):
@@ -28,19 +36,43 @@ class NoFlightFound(BaseModel):
   """When no valid flight is found."""
 
 
+class FlightIndex:
+  """Extracted flights by origin, destination and date, each sorted by price, cheapest first."""
+
+  def __init__(self, flights: Iterable[FlightDetails]) -> None:
+    self._routes: dict[tuple[str, str, datetime.date], list[FlightDetails]] = defaultdict(list)
+    for flight in flights:
+      self._routes[(flight.origin.upper(), flight.destination.upper(), flight.date)].append(flight)
+    for route in self._routes.values():
+      route.sort(key=lambda flight: (flight.price, flight.flight_number))
+
+  def __len__(self) -> int:
+    return sum(len(route) for route in self._routes.values())
+
+  def candidates(self, origin: str, destination: str, date: datetime.date) -> list[FlightDetails]:
+    return list(self._routes.get((origin.upper(), destination.upper(), date), []))
+
+
 @dataclass
 class Deps:
   web_page_text: str
   req_origin: str
   req_destination: str
   req_date: datetime.date
+  # indexes by page content hash, so every search of the session reuses the extraction
+  indexes: dict[str, asyncio.Task[FlightIndex]] = field(default_factory=dict)
+  # flights already offered to the user, searching again moves past them
+  offered: set[str] = field(default_factory=set)
 
 
 search_agent = Agent[Deps, FlightDetails | NoFlightFound](
   model=model,
   output_type=FlightDetails | NoFlightFound,  # type: ignore
   retries=4,
-  system_prompt=('Your job is to find the cheapest flight for the user on the given date. '),
+  system_prompt=(
+    'Your job is to find the cheapest flight for the user on the given date. '
+    'Only choose among the flights returned by `find_flights`, if there are none no valid flight was found.'
+  ),
 )
 
 extraction_agent = Agent(
@@ -51,12 +83,70 @@ extraction_agent = Agent(
 
 
 @search_agent.tool
-async def extract_flights(ctx: RunContext[Deps]) -> list[FlightDetails]:
-  """Get details of all flights."""
-  # we pass the usage to the search agent so requests within this agent are counted
-  result = await extraction_agent.run(ctx.deps.web_page_text, usage=ctx.usage)
-  logfire.info('found {flight_count} flights', flight_count=len(result.output))
-  return result.output
+async def find_flights(ctx: RunContext[Deps]) -> list[FlightDetails]:
+  """Get the flights with the requested origin, destination and date that weren't offered yet, cheapest first."""
+  return await find_candidates(ctx.deps, ctx.usage)
+
+
+async def find_candidates(deps: Deps, usage: RunUsage) -> list[FlightDetails]:
+  index = await flight_index(deps, usage)
+  candidates = index.candidates(deps.req_origin, deps.req_destination, deps.req_date)
+  return [flight for flight in candidates if flight.flight_number not in deps.offered]
+
+
+async def flight_index(deps: Deps, usage: RunUsage) -> FlightIndex:
+  key = hashlib.sha256(deps.web_page_text.encode()).hexdigest()
+  task = deps.indexes.get(key)
+  if task is None:
+    # a task rather than the result, so concurrent calls share one extraction
+    task = deps.indexes[key] = asyncio.create_task(build_index(deps.web_page_text, usage))
+  try:
+    # shielded, so a caller that's cancelled doesn't cancel the extraction for everyone else
+    return await asyncio.shield(task)
+  except BaseException:
+    # every caller waiting on the failed task gets here, only drop it if a retry hasn't replaced it yet
+    failed = task.done() and (task.cancelled() or task.exception() is not None)
+    if failed and deps.indexes.get(key) is task:
+      del deps.indexes[key]
+    raise
+
+
+async def build_index(text: str, usage: RunUsage) -> FlightIndex:
+  return FlightIndex(await extract_page(text, usage))
+
+
+async def extract_page(text: str, usage: RunUsage) -> list[FlightDetails]:
+  chunks = split_records(text, MAX_EXTRACTION_CHUNK_CHARS)
+  semaphore = asyncio.Semaphore(MAX_EXTRACTION_CONCURRENCY)
+
+  async def extract(chunk: str) -> list[FlightDetails]:
+    async with semaphore:
+      # we pass the usage to the search agent so requests within this agent are counted
+      result = await extraction_agent.run(chunk, usage=usage)
+      return result.output
+
+  results = await asyncio.gather(*(extract(chunk) for chunk in chunks))
+  # a flight is only listed once, but the model may repeat it from a neighbouring chunk
+  flights: dict[tuple[str, datetime.date], FlightDetails] = {}
+  for output in results:
+    for flight in output:
+      flights.setdefault((flight.flight_number, flight.date), flight)
+  logfire.info('found {flight_count} flights in {chunk_count} chunks', flight_count=len(flights), chunk_count=len(chunks))
+  return list(flights.values())
+
+
+def split_records(text: str, max_chars: int) -> list[str]:
+  """Split text into chunks of at most `max_chars`, only between records, which are separated by blank lines.
+
+  A single record longer than `max_chars` is kept whole, so no flight is ever cut in two.
+  """
+  chunks: list[str] = []
+  for record in re.split(r'\n\s*\n', text.strip()):
+    if chunks and len(chunks[-1]) + len(record) + 2 <= max_chars:
+      chunks[-1] += f'\n\n{record}'
+    else:
+      chunks.append(record)
+  return chunks
 
 
 @search_agent.output_validator
@@ -75,6 +165,9 @@ async def validate_output(
   if output.date != ctx.deps.req_date:
     errors.append(f'Flight should be on {ctx.deps.req_date}, not {output.date}')
 
+  if not errors and output not in await find_candidates(ctx.deps, ctx.usage):
+    errors.append(f'Flight {output.flight_number} is not one of the flights returned by `find_flights`')
+
   if errors:
     raise ModelRetry('\n'.join(errors))
   return output
@@ -161,21 +254,20 @@ async def main():
     req_destination='ANC',
     req_date=datetime.date(2025, 1, 10),
   )
-  message_history: list[ModelMessage] | None = None
   usage: RunUsage = RunUsage()
+  result = await search_agent.run(
+    f'Find me a flight from {deps.req_origin} to {deps.req_destination} on {deps.req_date}',
+    deps=deps,
+    usage=usage,
+    usage_limits=usage_limits,
+  )
+  flight = result.output
   while True:
-    result = await search_agent.run(
-      f'Find me a flight from {deps.req_origin} to {deps.req_destination} on {deps.req_date}',
-      deps=deps,
-      usage=usage,
-      message_history=message_history,
-      usage_limits=usage_limits,
-    )
-    if isinstance(result.output, NoFlightFound):
+    if isinstance(flight, NoFlightFound):
       print('No flight found')
       break
-    flight = result.output
     print(f'Flight found: {flight}')
+    deps.offered.add(flight.flight_number)
     answer = Prompt.ask(
       'Do you want to buy this flight, or keep searching? (buy/*search)',
       choices=['buy', 'search', ''],
@@ -185,7 +277,9 @@ async def main():
       seat = await find_seat(usage)
       await buy_tickets(flight, seat)
       break
-    message_history = result.all_messages(output_tool_return_content='Please suggest another flight')
+    # the next cheapest valid flight comes straight from the index, without asking the model again
+    candidates = await find_candidates(deps, usage)
+    flight = candidates[0] if candidates else NoFlightFound()
 
 
 async def find_seat(usage: RunUsage) -> SeatPreference:
@@ -0,0 +1,166 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable, Mapping
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import httpx
+
+
+@dataclass
+class CacheStats:
+  hits: int = 0
+  disk_hits: int = 0
+  # requests that waited for an identical one already in flight
+  shared: int = 0
+  misses: int = 0
+
+  @property
+  def hit_rate(self) -> float:
+    """Share of requests that didn't go to the network."""
+    total = self.hits + self.disk_hits + self.shared + self.misses
+    return (total - self.misses) / total if total else 0.0
+
+
+@dataclass
+class CachedResponse:
+  status_code: int
+  content_type: str | None
+  content: bytes
+  expires_at: float
+
+  def to_response(self, request: httpx.Request) -> httpx.Response:
+    headers = {'content-type': self.content_type} if self.content_type else None
+    return httpx.Response(self.status_code, headers=headers, content=self.content, request=request)
+
+
+class ResponseCache:
+  """Cache of successful GET responses, with a TTL per endpoint URL.
+
+  Endpoints without a TTL aren't cached. Identical requests in flight share one call. Responses of
+  the `persistent` endpoints are also stored in SQLite at `path`, so they survive restarts, which suits
+  data that barely changes like geocodes. The memory tier keeps at most `max_entries` responses.
+  """
+
+  def __init__(
+    self,
+    ttls: Mapping[str, float],
+    path: str | Path | None = None,
+    persistent: Iterable[str] = (),
+    max_entries: int = 1024,
+  ) -> None:
+    self.ttls = dict(ttls)
+    self.persistent = frozenset(persistent)
+    self.max_entries = max_entries
+    self.stats = CacheStats()
+    self._memory: OrderedDict[str, CachedResponse] = OrderedDict()
+    self._in_flight: dict[str, asyncio.Task[httpx.Response]] = {}
+    self._lock = threading.Lock()
+    self._conn: sqlite3.Connection | None = None
+    if path is not None:
+      self._conn = sqlite3.connect(path, check_same_thread=False)
+      self._conn.executescript(
+        """
+        PRAGMA journal_mode = WAL;
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            status_code INTEGER NOT NULL,
+            content_type TEXT,
+            content BLOB NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        """
+      )
+
+  async def get(self, client: httpx.AsyncClient, url: str, params: Mapping[str, Any] | None = None) -> httpx.Response:
+    """GET `url` with `client`, or from the cache if there's an unexpired response."""
+    ttl = self.ttls.get(url)
+    request = client.build_request('GET', url, params=dict(sorted((params or {}).items())))
+    if ttl is None:
+      return await client.send(request)
+
+    key = str(request.url)
+    cached = self._get_memory(key)
+    if cached is not None:
+      self.stats.hits += 1
+      return cached.to_response(request)
+    if self._conn is not None and url in self.persistent:
+      cached = await asyncio.to_thread(self._get_disk, key)
+      if cached is not None:
+        self.stats.disk_hits += 1
+        self._put_memory(key, cached)
+        return cached.to_response(request)
+
+    task = self._in_flight.get(key)
+    if task is not None:
+      self.stats.shared += 1
+    else:
+      self.stats.misses += 1
+      task = self._in_flight[key] = asyncio.create_task(self._fetch(client, request, key, url, ttl))
+      # dropped once the fetch is done, not when the caller that started it stops waiting
+      task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+    # shielded, so a caller that's cancelled doesn't cancel the fetch for the others waiting on it
+    return await asyncio.shield(task)
+
+  def clear(self) -> None:
+    self._memory.clear()
+    if self._conn is not None:
+      with self._lock, self._conn:
+        self._conn.execute('DELETE FROM responses')
+
+  def close(self) -> None:
+    if self._conn is not None:
+      self._conn.close()
+
+  async def _fetch(
+    self, client: httpx.AsyncClient, request: httpx.Request, key: str, url: str, ttl: float
+  ) -> httpx.Response:
+    response = await client.send(request)
+    # errors aren't cached, the next request tries again
+    if response.is_success:
+      cached = CachedResponse(
+        response.status_code, response.headers.get('content-type'), response.content, time.time() + ttl
+      )
+      self._put_memory(key, cached)
+      if self._conn is not None and url in self.persistent:
+        await asyncio.to_thread(self._put_disk, key, cached)
+    return response
+
+  def _get_memory(self, key: str) -> CachedResponse | None:
+    cached = self._memory.get(key)
+    if cached is None:
+      return None
+    if cached.expires_at < time.time():
+      del self._memory[key]
+      return None
+    self._memory.move_to_end(key)
+    return cached
+
+  def _put_memory(self, key: str, cached: CachedResponse) -> None:
+    self._memory[key] = cached
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.max_entries:
+      self._memory.popitem(last=False)
+
+  def _get_disk(self, key: str) -> CachedResponse | None:
+    assert self._conn is not None
+    with self._lock:
+      row = self._conn.execute(
+        'SELECT status_code, content_type, content, expires_at FROM responses WHERE key = ? AND expires_at >= ?',
+        (key, time.time()),
+      ).fetchone()
+    return CachedResponse(*row) if row else None
+
+  def _put_disk(self, key: str, cached: CachedResponse) -> None:
+    assert self._conn is not None
+    with self._lock, self._conn:
+      self._conn.execute(
+        'INSERT OR REPLACE INTO responses (key, status_code, content_type, content, expires_at) VALUES (?, ?, ?, ?, ?)',
+        (key, cached.status_code, cached.content_type, cached.content, cached.expires_at),
+      )
@@ -0,0 +1,175 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import importlib.util
+import random
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from typing import Any
+
+import httpx
+import logfire
+
+# idempotent requests are retried on these, or on any transport error
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+# HTTP/2 needs the optional `h2` package, `pip install httpx[http2]`
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+  """Response body that frees its host slot once read or closed, so streamed responses count too."""
+
+  def __init__(self, stream: httpx.AsyncByteStream, slot: asyncio.Semaphore) -> None:
+    self._stream = stream
+    self._slot = slot
+    self._released = False
+
+  async def __aiter__(self) -> AsyncIterator[bytes]:
+    async for chunk in self._stream:
+      yield chunk
+
+  async def aclose(self) -> None:
+    try:
+      await self._stream.aclose()
+    finally:
+      if not self._released:
+        self._released = True
+        self._slot.release()
+
+
+class PooledTransport(httpx.AsyncBaseTransport):
+  """Keep-alive connection pool with at most `per_host` requests in flight to each host, and retries.
+
+  Connection failures are retried for every request, since nothing was sent, other transport errors
+  and `RETRY_STATUSES` only for idempotent methods. Retries back off exponentially with jitter, or
+  as long as the server's `Retry-After` asks, up to `max_backoff` seconds.
+  """
+
+  def __init__(
+    self,
+    limits: httpx.Limits,
+    http2: bool,
+    per_host: int,
+    retries: int,
+    backoff: float,
+    max_backoff: float,
+  ) -> None:
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self._transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+    self._slots: defaultdict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(per_host))
+
+  async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+    slot = self._slots[request.url.host]
+    await slot.acquire()
+    try:
+      response = await self._send(request)
+    except BaseException:
+      slot.release()
+      raise
+    assert isinstance(response.stream, httpx.AsyncByteStream)
+    return httpx.Response(
+      response.status_code,
+      headers=response.headers,
+      stream=_ReleasingStream(response.stream, slot),
+      extensions=response.extensions,
+    )
+
+  async def aclose(self) -> None:
+    await self._transport.aclose()
+
+  async def _send(self, request: httpx.Request) -> httpx.Response:
+    idempotent = request.method in IDEMPOTENT_METHODS
+    attempt = 0
+    while True:
+      retry_after: str | None = None
+      try:
+        response = await self._transport.handle_async_request(request)
+      except (httpx.ConnectError, httpx.ConnectTimeout):
+        if attempt == self.retries:
+          raise
+      except httpx.TransportError:
+        if attempt == self.retries or not idempotent:
+          raise
+      else:
+        if attempt == self.retries or not idempotent or response.status_code not in RETRY_STATUSES:
+          return response
+        retry_after = response.headers.get('retry-after')
+        await response.aclose()
+      attempt += 1
+      delay = self._delay(attempt, retry_after)
+      logfire.info(
+        'retry {attempt} of {method} {url} in {delay:.2f}s',
+        attempt=attempt,
+        method=request.method,
+        url=str(request.url),
+        delay=delay,
+      )
+      await asyncio.sleep(delay)
+
+  def _delay(self, attempt: int, retry_after: str | None) -> float:
+    if retry_after is not None:
+      try:
+        return min(float(retry_after), self.max_backoff)
+      except ValueError:
+        pass
+    return min(self.backoff * 2 ** (attempt - 1), self.max_backoff) * random.uniform(0.5, 1)
+
+
+class HttpClients:
+  """Shared `httpx.AsyncClient`s by name, so tools and API clients reuse warm connections.
+
+  Clients are created on first use with tuned pool limits, keep-alive, a concurrency cap per host,
+  retries, and HTTP/2 when `h2` is installed. Use the registry as an async context manager around
+  the work, or call `aclose`, to close them; a later `get` opens fresh clients.
+  """
+
+  def __init__(
+    self,
+    *,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 30,
+    per_host: int = 16,
+    retries: int = 3,
+    backoff: float = 0.5,
+    max_backoff: float = 10,
+    timeout: float = 30,
+    http2: bool = HTTP2_AVAILABLE,
+  ) -> None:
+    self.limits = httpx.Limits(
+      max_connections=max_connections,
+      max_keepalive_connections=max_keepalive_connections,
+      keepalive_expiry=keepalive_expiry,
+    )
+    self.per_host = per_host
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.timeout = timeout
+    self.http2 = http2
+    self._clients: dict[str, httpx.AsyncClient] = {}
+
+  def get(self, name: str = 'default', **kwargs: Any) -> httpx.AsyncClient:
+    """The client called `name`, `kwargs` like `base_url` or `headers` apply when it's created."""
+    client = self._clients.get(name)
+    if client is None or client.is_closed:
+      transport = PooledTransport(self.limits, self.http2, self.per_host, self.retries, self.backoff, self.max_backoff)
+      client = self._clients[name] = httpx.AsyncClient(transport=transport, timeout=self.timeout, **kwargs)
+    return client
+
+  async def aclose(self) -> None:
+    clients, self._clients = self._clients, {}
+    await asyncio.gather(*(client.aclose() for client in clients.values()))
+
+  async def __aenter__(self) -> HttpClients:
+    return self
+
+  async def __aexit__(self, *_args: Any) -> None:
+    await self.aclose()
+
+
+# the process wide registry, entry points close it when they're done
+HTTP_CLIENTS = HttpClients()
@@ -0,0 +1,187 @@
+from __future__ import annotations as _annotations
+
+import codecs
+import json
+import re
+from collections.abc import AsyncIterable, AsyncIterator
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+
+_WHITESPACE = re.compile(r'\s*')
+_STRUCTURE = re.compile(r'[\[\]{}"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[\s,\]]')
+_HEADING = re.compile(r'^#{1,6}\s')
+
+
+@dataclass
+class _ValueScan:
+  """An array element whose end hasn't been seen yet, with its text so far, kept across chunks."""
+
+  scalar: bool
+  parts: list[str] = field(default_factory=list)
+  depth: int = 0
+  in_string: bool = False
+  escaped: bool = False
+
+
+def _scan_value(text: str, pos: int, scan: _ValueScan) -> int | None:
+  """Continue scanning the element from `pos`, returning its end in `text`, or `None` if it goes on.
+
+  Each character is scanned once, however many chunks the element spans. Scalars like numbers are
+  only complete once a delimiter follows them, `1` may be the start of `12345`.
+  """
+  if scan.scalar:
+    match = _SCALAR_END.search(text, pos)
+    return match.start() if match else None
+
+  while True:
+    if scan.escaped:
+      if pos == len(text):
+        return None
+      scan.escaped = False
+      pos += 1
+    if scan.in_string:
+      match = _STRING_SPECIAL.search(text, pos)
+      if match is None:
+        return None
+      pos = match.end()
+      if match.group() == '\\':
+        scan.escaped = True
+        continue
+      scan.in_string = False
+      if scan.depth == 0:
+        return pos
+    else:
+      match = _STRUCTURE.search(text, pos)
+      if match is None:
+        return None
+      pos = match.end()
+      if match.group() == '"':
+        scan.in_string = True
+      elif match.group() in '[{':
+        scan.depth += 1
+      else:
+        scan.depth -= 1
+        if scan.depth == 0:
+          return pos
+
+
+async def iter_json_array(chunks: AsyncIterable[bytes]) -> AsyncIterator[Any]:
+  """Incrementally parse a top-level JSON array of objects, yielding each element as it completes.
+
+  Only the element currently being parsed is buffered, so memory stays bounded by the largest
+  element rather than the size of the document.
+  """
+  text_decoder = codecs.getincrementaldecoder('utf-8')()
+  started = finished = False
+  expect_value = True
+  scan: _ValueScan | None = None
+
+  async for chunk in chunks:
+    text = text_decoder.decode(chunk)
+    pos = 0
+    while True:
+      if scan is not None:
+        end = _scan_value(text, pos, scan)
+        if end is None:
+          # the element is incomplete, wait for more data
+          scan.parts.append(text[pos:])
+          break
+        scan.parts.append(text[pos:end])
+        value = json.loads(''.join(scan.parts))
+        scan = None
+        pos = end
+        expect_value = False
+        yield value
+        continue
+
+      pos = _WHITESPACE.match(text, pos).end()  # pyright: ignore[reportOptionalMemberAccess]
+      if pos == len(text):
+        break
+      if finished:
+        raise ValueError('Trailing data after JSON array')
+      if not started:
+        if text[pos] != '[':
+          raise ValueError(f'Expected a JSON array, got {text[pos]!r}')
+        started = True
+        pos += 1
+      elif text[pos] == ']':
+        finished = True
+        pos += 1
+      elif not expect_value:
+        if text[pos] != ',':
+          raise ValueError(f'Expected "," or "]" between array elements, got {text[pos]!r}')
+        expect_value = True
+        pos += 1
+      else:
+        scan = _ValueScan(scalar=text[pos] not in '[{"')
+
+  if not finished:
+    raise ValueError('Truncated JSON array')
+
+
+def chunk_markdown(text: str, max_chars: int) -> list[str]:
+  """Split markdown into chunks of at most `max_chars`, preferring heading then paragraph boundaries."""
+  if len(text) <= max_chars:
+    return [text]
+
+  # split before each heading that isn't inside a fenced code block
+  blocks: list[str] = []
+  current: list[str] = []
+  in_fence = False
+  for line in text.splitlines(keepends=True):
+    if line.lstrip().startswith('```'):
+      in_fence = not in_fence
+    if not in_fence and _HEADING.match(line) and current:
+      blocks.append(''.join(current))
+      current = []
+    current.append(line)
+  if current:
+    blocks.append(''.join(current))
+
+  pieces: list[str] = []
+  for block in blocks:
+    if len(block) <= max_chars:
+      pieces.append(block)
+      continue
+    for paragraph in re.split(r'(?<=\n\n)', block):
+      pieces.extend(paragraph[i : i + max_chars] for i in range(0, len(paragraph), max_chars))
+
+  chunks: list[str] = []
+  for piece in pieces:
+    if chunks and len(chunks[-1]) + len(piece) <= max_chars:
+      chunks[-1] += piece
+    else:
+      chunks.append(piece)
+  return chunks
+
+
+@dataclass
+class IngestCheckpoint:
+  """Progress of a streaming ingestion, saved after every committed batch so a crashed run can resume."""
+
+  path: Path = field(repr=False)
+  source: str
+  etag: str | None = None
+  sections_done: int = 0
+
+  @classmethod
+  def load(cls, path: str | Path, source: str) -> IngestCheckpoint:
+    path = Path(path)
+    if path.exists():
+      data = json.loads(path.read_text())
+      if data['source'] == source:
+        return cls(path, **data)
+    return cls(path, source)
+
+  def save(self) -> None:
+    data = asdict(self)
+    del data['path']
+    tmp = self.path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(data))
+    tmp.replace(self.path)
+
+  def clear(self) -> None:
+    self.path.unlink(missing_ok=True)
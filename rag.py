@@ -1,29 +1,118 @@
 from __future__ import annotations as _annotations
 
 import asyncio
+import hashlib
 import re
+import struct
 import sys
+import time
 import unicodedata
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Literal
 
 import asyncpg
 import httpx
 import logfire
-import pydantic_core
+import numpy as np
 from openai import AsyncOpenAI
 from pydantic import TypeAdapter
 from pydantic_ai import Agent, RunContext
 
-from constant import CLIENT, model
+from answer_cache import Answer, SemanticAnswerCache
+from constant import model
+from embeddings import EmbeddingCache, EmbeddingService, Vector
+from http_clients import HTTP_CLIENTS
+from ingest import IngestCheckpoint, chunk_markdown, iter_json_array
+from vector_store import NumpyRetriever, Retriever, SectionHit, reciprocal_rank_fusion
+
+EMBEDDING_CACHE_FILE = 'embedding_cache.db'
+ANSWER_CACHE_FILE = 'answer_cache.db'
+INGEST_CHECKPOINT_FILE = 'ingest_checkpoint.json'
+# keeps each chunk comfortably inside the embedding model's context
+MAX_CHUNK_CHARS = 4000
+NUMPY_INDEX_DIR = 'doc_sections_index'
 
 
 @dataclass
-class Deps:
-  openai: AsyncOpenAI
+class PgvectorRetriever:
+  """Retriever backed by the `doc_sections` table and its HNSW index."""
+
   pool: asyncpg.Pool
 
+  async def search(self, embedding: Vector, k: int) -> list[SectionHit]:
+    rows = await self.pool.fetch(
+      'SELECT url, title, content, embedding <-> $1 AS distance FROM doc_sections ORDER BY embedding <-> $1 LIMIT $2',
+      embedding,
+      k,
+    )
+    return [SectionHit(**row) for row in rows]
+
+  async def text_search(self, query: str, k: int) -> list[SectionHit]:
+    rows = await self.pool.fetch(
+      """
+      SELECT url, title, content
+      FROM doc_sections, websearch_to_tsquery('english', $1) query
+      WHERE search_vector @@ query
+      ORDER BY ts_rank_cd(search_vector, query) DESC
+      LIMIT $2
+      """,
+      query,
+      k,
+    )
+    return [SectionHit(**row) for row in rows]
+
+
+_embeddings: EmbeddingService | None = None
+
+
+def shared_embeddings() -> EmbeddingService:
+  """The process wide embedding service, so queries of concurrent runs are coalesced into shared batches."""
+  global _embeddings
+  if _embeddings is None:
+    openai = AsyncOpenAI(http_client=HTTP_CLIENTS.get('openai'))
+    logfire.instrument_openai(openai)
+    _embeddings = EmbeddingService(openai, cache=EmbeddingCache(EMBEDDING_CACHE_FILE))
+  return _embeddings
+
+
+async def close_embeddings() -> None:
+  global _embeddings
+  if _embeddings is not None:
+    await _embeddings.aclose()
+    _embeddings = None
+
+
+_answer_cache: SemanticAnswerCache | None = None
+
+
+def shared_answer_cache() -> SemanticAnswerCache:
+  """The process wide answer cache, so every entry point reuses one SQLite connection."""
+  global _answer_cache
+  if _answer_cache is None:
+    _answer_cache = SemanticAnswerCache(ANSWER_CACHE_FILE)
+  return _answer_cache
+
+
+def close_answer_cache() -> None:
+  global _answer_cache
+  if _answer_cache is not None:
+    _answer_cache.close()
+    _answer_cache = None
+
+
+@dataclass
+class Deps:
+  retriever: Retriever
+  search_mode: Literal['vector', 'hybrid'] = 'hybrid'
+  search_k: int = 8
+  # rough budget for the text returned by `retrieve`, at ~4 characters per token
+  context_token_budget: int = 3000
+  # URLs of every section `retrieve` returned during the run, recorded as sources of the answer
+  retrieved_urls: set[str] = field(default_factory=set)
+  embeddings: EmbeddingService = field(default_factory=shared_embeddings)
+
 
 agent = Agent(model, deps_type=Deps)
 
@@ -36,33 +125,74 @@ async def retrieve(context: RunContext[Deps], search_query: str) -> str:
       context: The call context.
       search_query: The search query.
   """
-  with logfire.span('create embedding for {search_query=}', search_query=search_query):
-    embedding = CLIENT.embeddings.create(
-      input=search_query,
-      model='llama-3.2-3b-instruct',
-    )
-
-  assert len(embedding.data) == 1, f'Expected 1 embedding, got {len(embedding.data)}, doc query: {search_query!r}'
-  embedding = embedding.data[0].embedding
-  embedding_json = pydantic_core.to_json(embedding).decode()
-  rows = await context.deps.pool.fetch(
-    'SELECT url, title, content FROM doc_sections ORDER BY embedding <-> $1 LIMIT 8',
-    embedding_json,
-  )
-  return '\n\n'.join(f'# {row["title"]}\nDocumentation URL:{row["url"]}\n\n{row["content"]}\n' for row in rows)
-
-
-async def run_agent(question: str):
+  deps = context.deps
+
+  # each hybrid leg over-fetches so fusion has candidates to re-rank
+  leg_k = deps.search_k * 2 if deps.search_mode == 'hybrid' else deps.search_k
+
+  async def vector_search() -> list[SectionHit]:
+    with logfire.span('create embedding for {search_query=}', search_query=search_query):
+      embedding = await deps.embeddings.embed(search_query)
+    return await deps.retriever.search(embedding, leg_k)
+
+  if deps.search_mode == 'hybrid':
+    # the lexical leg doesn't need the embedding, so both legs run concurrently
+    vector_hits, text_hits = await asyncio.gather(vector_search(), deps.retriever.text_search(search_query, leg_k))
+    hits = reciprocal_rank_fusion(vector_hits, text_hits, k=deps.search_k)
+  else:
+    hits = await vector_search()
+  deps.retrieved_urls.update(hit.url for hit in hits)
+  return format_sections(hits, deps.context_token_budget)
+
+
+def format_sections(hits: list[SectionHit], token_budget: int) -> str:
+  """Render hits as markdown, truncating once the approximate token budget is spent."""
+  char_budget = token_budget * 4
+  sections: list[str] = []
+  for hit in hits:
+    section = f'# {hit.title}\nDocumentation URL:{hit.url}\n\n{hit.content}\n'
+    if len(section) > char_budget:
+      if char_budget > 200 or not sections:
+        sections.append(section[:char_budget] + '…\n')
+      break
+    sections.append(section)
+    char_budget -= len(section)
+  return '\n\n'.join(sections)
+
+
+async def run_agent(question: str, backend: Literal['pgvector', 'numpy'] = 'pgvector'):
   """Entry point to run the agent and perform RAG based question answering."""
-  openai = AsyncOpenAI()
-  logfire.instrument_openai(openai)
-
   logfire.info('Asking "{question}"', question=question)
 
-  async with database_connect(False) as pool:
-    deps = Deps(openai=openai, pool=pool)
-    answer = await agent.run(question, deps=deps)
-  print(answer.output)
+  answer_cache = shared_answer_cache()
+  if backend == 'numpy':
+    deps = Deps(retriever=NumpyRetriever(NUMPY_INDEX_DIR))
+    answer = await answer_question(question, deps, answer_cache)
+  else:
+    async with database_connect(False) as pool:
+      deps = Deps(retriever=PgvectorRetriever(pool))
+      answer = await answer_question(question, deps, answer_cache)
+  print(answer.answer)
+  if answer.sources:
+    print('\nSources:\n' + '\n'.join(f'- {url}' for url in answer.sources))
+
+
+async def answer_question(question: str, deps: Deps, answer_cache: SemanticAnswerCache) -> Answer:
+  """Answer from the semantic cache when a similar question was answered recently, else run the agent."""
+  question_embedding = await deps.embeddings.embed(question)
+  cached = await answer_cache.lookup(question_embedding)
+  if cached is not None:
+    logfire.info(
+      'Answer cache hit for {question=}, similar to {cached_question=} ({similarity:.3f})',
+      question=question,
+      cached_question=cached.question,
+      similarity=cached.similarity,
+    )
+    return cached
+
+  result = await agent.run(question, deps=deps)
+  await answer_cache.store(question, question_embedding, result.output, deps.retrieved_urls)
+  return Answer(question, result.output, sorted(deps.retrieved_urls))
 
 
 DOCS_JSON = (
@@ -72,58 +202,318 @@ DOCS_JSON = (
 )
 
 
-async def build_search_db():
-  """Build the search database."""
-  async with httpx.AsyncClient() as client:
-    response = await client.get(DOCS_JSON)
+async def build_search_db(rebuild: bool = False):
+  """Build the search database.
+
+  By default this is an incremental sync: only chunks whose content hash changed are
+  re-embedded, and chunks no longer in the docs are deleted. `rebuild=True` re-embeds everything.
+  """
+  embeddings = shared_embeddings()
+
+  async with database_connect(True) as pool:
+    await create_schema(pool)
+
+    etag = None if rebuild else await pool.fetchval('SELECT etag FROM doc_sources WHERE url = $1', DOCS_JSON)
+    response = await HTTP_CLIENTS.get().get(DOCS_JSON, headers={'If-None-Match': etag} if etag else None)
+    if response.status_code == 304:
+      logfire.info('{url=} not modified, nothing to sync', url=DOCS_JSON)
+      return
     response.raise_for_status()
-  sections = sessions_ta.validate_json(response.content)
+    chunks = {chunk.key(): chunk for section in sessions_ta.validate_json(response.content) for chunk in section.chunks()}
+
+    with logfire.span('diff {count} chunks', count=len(chunks)):
+      existing: dict[tuple[str, int], str] = {}
+      if not rebuild:
+        rows = await pool.fetch('SELECT url, chunk_index, content_hash FROM doc_sections')
+        existing = {(row['url'], row['chunk_index']): row['content_hash'] for row in rows}
+      changed = [chunk for key, chunk in chunks.items() if rebuild or existing.get(key) != chunk.content_hash()]
+      vanished = [key for key in existing if key not in chunks]
+    logfire.info(
+      '{changed} new or changed chunks, {vanished} vanished, {unchanged} unchanged',
+      changed=len(changed),
+      vanished=len(vanished),
+      unchanged=len(chunks) - len(changed),
+    )
 
-  openai = AsyncOpenAI()
-  logfire.instrument_openai(openai)
+    with logfire.span('create embeddings for {count} chunks', count=len(changed)):
+      chunk_embeddings = await embeddings.embed_many([chunk.embedding_content() for chunk in changed])
+
+    with logfire.span('write chunks'):
+      async with pool.acquire() as conn:
+        async with conn.transaction():
+          if rebuild:
+            await conn.execute('TRUNCATE doc_sections')
+          elif vanished:
+            await conn.execute(
+              'DELETE FROM doc_sections WHERE (url, chunk_index) IN (SELECT * FROM unnest($1::text[], $2::int[]))',
+              [url for url, _ in vanished],
+              [chunk_index for _, chunk_index in vanished],
+            )
+          await write_doc_chunks(conn, changed, chunk_embeddings)
+          await conn.execute(
+            'INSERT INTO doc_sources (url, etag) VALUES ($1, $2) ON CONFLICT (url) DO UPDATE SET etag = $2',
+            DOCS_JSON,
+            response.headers.get('etag'),
+          )
+
+    answer_cache = shared_answer_cache()
+    if rebuild:
+      answer_cache.clear()
+    else:
+      invalidated = answer_cache.invalidate([chunk.url for chunk in changed] + [url for url, _ in vanished])
+      logfire.info('invalidated {count} cached answers', count=invalidated)
+
+  log_embedding_stats(embeddings)
+
+
+@dataclass
+class ChunkBatch:
+  """Chunks of consecutive whole sections, the unit passed between ingestion stages."""
+
+  last_section: int
+  chunks: list[DocsChunk]
+  changed: list[DocsChunk] = field(default_factory=list)
+  embeddings: list[Vector] = field(default_factory=list)
+
+
+async def ingest_search_db(batch_size: int = 64, queue_size: int = 4) -> None:
+  """Streaming, resumable variant of `build_search_db` whose memory use doesn't grow with the corpus.
+
+  The download is parsed incrementally and flows through download -> chunk -> embed -> write
+  stages connected by bounded queues, so a slow stage applies backpressure upstream. Progress
+  is checkpointed after every written batch and an interrupted run resumes from there.
+  """
+  checkpoint = IngestCheckpoint.load(INGEST_CHECKPOINT_FILE, DOCS_JSON)
+  embeddings = shared_embeddings()
+  answer_cache = shared_answer_cache()
 
   async with database_connect(True) as pool:
-    with logfire.span('create schema'):
+    await create_schema(pool)
+
+    etag = None
+    if not checkpoint.sections_done:
+      etag = await pool.fetchval('SELECT etag FROM doc_sources WHERE url = $1', DOCS_JSON)
+    client = HTTP_CLIENTS.get()
+    async with client.stream('GET', DOCS_JSON, headers={'If-None-Match': etag} if etag else None) as response:
+      if response.status_code == 304:
+        logfire.info('{url=} not modified, nothing to sync', url=DOCS_JSON)
+        return
+      response.raise_for_status()
+
+      source_etag = response.headers.get('etag')
+      if checkpoint.sections_done and checkpoint.etag != source_etag:
+        logfire.info('{url=} changed since the checkpoint, restarting ingestion', url=DOCS_JSON)
+        checkpoint.sections_done = 0
+      checkpoint.etag = source_etag
+      if not checkpoint.sections_done:
+        await pool.execute('TRUNCATE doc_ingest_seen')
+      else:
+        logfire.info('resuming after {sections} sections', sections=checkpoint.sections_done)
+
+      sections: asyncio.Queue[tuple[int, DocsSection] | None] = asyncio.Queue(batch_size * queue_size)
+      to_embed: asyncio.Queue[ChunkBatch | None] = asyncio.Queue(queue_size)
+      to_write: asyncio.Queue[ChunkBatch | None] = asyncio.Queue(queue_size)
+      async with asyncio.TaskGroup() as tg:
+        tg.create_task(download_stage(response, checkpoint.sections_done, sections))
+        tg.create_task(chunk_stage(pool, sections, to_embed, batch_size))
+        tg.create_task(embed_stage(embeddings, to_embed, to_write))
+        tg.create_task(write_stage(pool, to_write, checkpoint, answer_cache))
+
+    with logfire.span('delete vanished chunks'):
       async with pool.acquire() as conn:
         async with conn.transaction():
-          await conn.execute(DB_SCHEMA)
+          rows = await conn.fetch(
+            """
+            DELETE FROM doc_sections d
+            WHERE NOT EXISTS (SELECT 1 FROM doc_ingest_seen s WHERE s.url = d.url AND s.chunk_index = d.chunk_index)
+            RETURNING url
+            """
+          )
+          await conn.execute(
+            'INSERT INTO doc_sources (url, etag) VALUES ($1, $2) ON CONFLICT (url) DO UPDATE SET etag = $2',
+            DOCS_JSON,
+            checkpoint.etag,
+          )
+    answer_cache.invalidate(row['url'] for row in rows)
+    checkpoint.clear()
+
+  log_embedding_stats(embeddings)
+
+
+async def download_stage(
+  response: httpx.Response, skip: int, sections: asyncio.Queue[tuple[int, DocsSection] | None]
+) -> None:
+  index = 0
+  async for item in iter_json_array(response.aiter_bytes()):
+    index += 1
+    if index > skip:
+      await sections.put((index, section_ta.validate_python(item)))
+  await sections.put(None)
 
-    sem = asyncio.Semaphore(10)
-    async with asyncio.TaskGroup() as tg:
-      for section in sections:
-        tg.create_task(insert_doc_section(sem, openai, pool, section))
 
+async def chunk_stage(
+  pool: asyncpg.Pool,
+  sections: asyncio.Queue[tuple[int, DocsSection] | None],
+  to_embed: asyncio.Queue[ChunkBatch | None],
+  batch_size: int,
+) -> None:
+  async def flush(batch: ChunkBatch) -> None:
+    rows = await pool.fetch(
+      """
+      SELECT url, chunk_index, content_hash FROM doc_sections
+      WHERE (url, chunk_index) IN (SELECT * FROM unnest($1::text[], $2::int[]))
+      """,
+      [chunk.url for chunk in batch.chunks],
+      [chunk.index for chunk in batch.chunks],
+    )
+    existing = {(row['url'], row['chunk_index']): row['content_hash'] for row in rows}
+    # a URL repeated within the batch would make the upsert touch the same row twice
+    changed = {chunk.key(): chunk for chunk in batch.chunks if existing.get(chunk.key()) != chunk.content_hash()}
+    batch.changed = list(changed.values())
+    await to_embed.put(batch)
+
+  batch = ChunkBatch(0, [])
+  while (item := await sections.get()) is not None:
+    index, section = item
+    batch.chunks.extend(section.chunks())
+    batch.last_section = index
+    # batches always end on a section boundary so the checkpoint never splits a section
+    if len(batch.chunks) >= batch_size:
+      await flush(batch)
+      batch = ChunkBatch(0, [])
+  if batch.chunks:
+    await flush(batch)
+  await to_embed.put(None)
+
+
+async def embed_stage(
+  embeddings: EmbeddingService,
+  to_embed: asyncio.Queue[ChunkBatch | None],
+  to_write: asyncio.Queue[ChunkBatch | None],
+) -> None:
+  while (batch := await to_embed.get()) is not None:
+    batch.embeddings = await embeddings.embed_many([chunk.embedding_content() for chunk in batch.changed])
+    await to_write.put(batch)
+  await to_write.put(None)
 
-async def insert_doc_section(
-  sem: asyncio.Semaphore,
-  openai: AsyncOpenAI,
+
+async def write_stage(
   pool: asyncpg.Pool,
-  section: DocsSection,
+  to_write: asyncio.Queue[ChunkBatch | None],
+  checkpoint: IngestCheckpoint,
+  answer_cache: SemanticAnswerCache,
 ) -> None:
-  async with sem:
-    url = section.url()
-    exists = await pool.fetchval('SELECT 1 FROM doc_sections WHERE url = $1', url)
-    if exists:
-      logfire.info('Skipping {url=}', url=url)
-      return
+  while (batch := await to_write.get()) is not None:
+    with logfire.span('write {changed} of {count} chunks', changed=len(batch.changed), count=len(batch.chunks)):
+      async with pool.acquire() as conn:
+        async with conn.transaction():
+          await write_doc_chunks(conn, batch.changed, batch.embeddings)
+          await conn.execute(
+            'INSERT INTO doc_ingest_seen SELECT * FROM unnest($1::text[], $2::int[]) ON CONFLICT DO NOTHING',
+            [chunk.url for chunk in batch.chunks],
+            [chunk.index for chunk in batch.chunks],
+          )
+    answer_cache.invalidate(chunk.url for chunk in batch.changed)
+    checkpoint.sections_done = batch.last_section
+    checkpoint.save()
+
+
+def log_embedding_stats(embeddings: EmbeddingService) -> None:
+  stats = embeddings.stats
+  logfire.info(
+    'embedded {inputs} chunks in {requests} requests, {rate:.1f} inputs/s, cache hit rate {hit_rate:.0%}',
+    inputs=stats.inputs,
+    requests=stats.requests,
+    rate=stats.inputs_per_second,
+    hit_rate=embeddings.cache.stats.hit_rate if embeddings.cache else 0.0,
+  )
+
+
+async def create_schema(pool: asyncpg.Pool) -> None:
+  with logfire.span('create schema'):
+    async with pool.acquire() as conn:
+      async with conn.transaction():
+        await conn.execute(DB_SCHEMA)
 
-    with logfire.span('create embedding for {url=}', url=url):
-      embedding = CLIENT.embeddings.create(
-        input=section.embedding_content(),
-        model='llama-3.2-3b-instruct',
-      )
-    assert len(embedding.data) == 1, f'Expected 1 embedding, got {len(embedding.data)}, doc section: {section}'
-    embedding = embedding.data[0].embedding
-    embedding_json = pydantic_core.to_json(embedding).decode()
-    await pool.execute(
-      'INSERT INTO doc_sections (url, title, content, embedding) VALUES ($1, $2, $3, $4)',
-      url,
-      section.title,
-      section.content,
-      embedding_json,
+
+async def write_doc_chunks(
+  conn: asyncpg.Connection,
+  chunks: list[DocsChunk],
+  embeddings: list[Vector],
+) -> None:
+  """Upsert chunks and their embeddings by binary `COPY` into a staging table.
+
+  Must be called inside a transaction, the staging table is dropped on commit.
+  """
+  if not chunks:
+    return
+  await conn.execute(
+    'CREATE TEMP TABLE doc_sections_staging (LIKE doc_sections INCLUDING DEFAULTS) ON COMMIT DROP'
+  )
+  await conn.copy_records_to_table(
+    'doc_sections_staging',
+    columns=SECTION_COLUMNS,
+    records=(
+      (chunk.url, chunk.index, chunk.title, chunk.content, chunk.content_hash(), embedding)
+      for chunk, embedding in zip(chunks, embeddings)
+    ),
+  )
+  await conn.execute(
+    f"""
+    INSERT INTO doc_sections ({', '.join(SECTION_COLUMNS)})
+    SELECT {', '.join(SECTION_COLUMNS)} FROM doc_sections_staging
+    ON CONFLICT (url, chunk_index) DO UPDATE
+    SET title = EXCLUDED.title,
+        content = EXCLUDED.content,
+        content_hash = EXCLUDED.content_hash,
+        embedding = EXCLUDED.embedding
+    """
+  )
+
+
+SECTION_COLUMNS = ['url', 'chunk_index', 'title', 'content', 'content_hash', 'embedding']
+
+
+async def build_numpy_index(n_lists: int | None = None) -> NumpyRetriever:
+  """Build the in-process search index in `NUMPY_INDEX_DIR`, no Postgres required."""
+  response = await HTTP_CLIENTS.get().get(DOCS_JSON)
+  response.raise_for_status()
+  chunks = list(
+    {chunk.key(): chunk for section in sessions_ta.validate_json(response.content) for chunk in section.chunks()}.values()
+  )
+
+  embeddings = shared_embeddings()
+  with logfire.span('create embeddings for {count} chunks', count=len(chunks)):
+    chunk_embeddings = await embeddings.embed_many([chunk.embedding_content() for chunk in chunks])
+
+  shared_answer_cache().clear()
+  with logfire.span('write numpy index'):
+    return NumpyRetriever.build(
+      NUMPY_INDEX_DIR,
+      [SectionHit(chunk.url, chunk.title, chunk.content) for chunk in chunks],
+      chunk_embeddings,
+      n_lists=n_lists,
     )
 
 
+async def benchmark_retrievers(queries: list[str], k: int = 8, runs: int = 20) -> None:
+  """Compare search latency of the in-process index against the pgvector HNSW index."""
+  embeddings = shared_embeddings()
+  query_embeddings = await embeddings.embed_many(queries)
+
+  async with database_connect(False) as pool:
+    retrievers: dict[str, Retriever] = {'pgvector': PgvectorRetriever(pool), 'numpy': NumpyRetriever(NUMPY_INDEX_DIR)}
+    for name, retriever in retrievers.items():
+      latencies: list[float] = []
+      for _ in range(runs):
+        for embedding in query_embeddings:
+          start = time.perf_counter()
+          await retriever.search(embedding, k)
+          latencies.append(time.perf_counter() - start)
+      p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+      print(f'{name}: p50={p50:.3f}ms p99={p99:.3f}ms over {len(latencies)} searches')
+
+
 @dataclass
 class DocsSection:
   id: int
@@ -137,11 +527,36 @@ class DocsSection:
     url_path = re.sub(r'\.md$', '', self.path)
     return f'https://logfire.pydantic.dev/docs/{url_path}/#{slugify(self.title, "-")}'
 
+  def chunks(self, max_chars: int = MAX_CHUNK_CHARS) -> list[DocsChunk]:
+    url = self.url()
+    return [
+      DocsChunk(url, index, self.path, self.title, content)
+      for index, content in enumerate(chunk_markdown(self.content, max_chars))
+    ]
+
+
+@dataclass
+class DocsChunk:
+  """A size-bounded piece of a `DocsSection`, the unit that gets embedded and stored."""
+
+  url: str
+  index: int
+  path: str
+  title: str
+  content: str
+
+  def key(self) -> tuple[str, int]:
+    return self.url, self.index
+
   def embedding_content(self) -> str:
     return '\n\n'.join((f'path: {self.path}', f'title: {self.title}', self.content))
 
+  def content_hash(self) -> str:
+    return hashlib.sha256(self.embedding_content().encode()).hexdigest()
+
 
 sessions_ta = TypeAdapter(list[DocsSection])
+section_ta = TypeAdapter(DocsSection)
 
 
 @asynccontextmanager
@@ -162,25 +577,77 @@ async def database_connect(
       finally:
         await conn.close()
 
-  pool = await asyncpg.create_pool(f'{server_dsn}/{database}')
+      # the vector type must exist before the pool registers its binary codec
+      conn = await asyncpg.connect(f'{server_dsn}/{database}')
+      try:
+        await conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
+      finally:
+        await conn.close()
+
+  pool = await asyncpg.create_pool(f'{server_dsn}/{database}', init=register_vector_codec)
   try:
     yield pool
   finally:
     await pool.close()
 
 
+async def register_vector_codec(conn: asyncpg.Connection) -> None:
+  """Send and receive pgvector values in their binary format as float32 NumPy arrays."""
+  await conn.set_type_codec(
+    'vector',
+    schema='public',
+    encoder=encode_vector,
+    decoder=decode_vector,
+    format='binary',
+  )
+
+
+def encode_vector(vector: Vector) -> bytes:
+  # pgvector binary layout: int16 dimensions, int16 unused, then big-endian float32 values
+  return struct.pack('>HH', len(vector), 0) + np.asarray(vector, dtype='>f4').tobytes()
+
+
+def decode_vector(data: bytes) -> Vector:
+  dim, _ = struct.unpack_from('>HH', data)
+  return np.frombuffer(data, dtype='>f4', count=dim, offset=4).astype(np.float32)
+
+
 DB_SCHEMA = """
 CREATE EXTENSION IF NOT EXISTS vector;
 
 CREATE TABLE IF NOT EXISTS doc_sections (
     id serial PRIMARY KEY,
-    url text NOT NULL UNIQUE,
+    url text NOT NULL,
+    chunk_index int NOT NULL DEFAULT 0,
     title text NOT NULL,
     content text NOT NULL,
+    content_hash text NOT NULL DEFAULT '',
     -- text-embedding-3-small returns a vector of 1536 floats
     embedding vector(1536) NOT NULL
 );
+-- tables created before content hashes were tracked get re-embedded on the next sync
+ALTER TABLE doc_sections ADD COLUMN IF NOT EXISTS content_hash text NOT NULL DEFAULT '';
+-- long sections are stored as several chunks, keyed by (url, chunk_index)
+ALTER TABLE doc_sections ADD COLUMN IF NOT EXISTS chunk_index int NOT NULL DEFAULT 0;
+ALTER TABLE doc_sections DROP CONSTRAINT IF EXISTS doc_sections_url_key;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_doc_sections_url_chunk ON doc_sections (url, chunk_index);
+ALTER TABLE doc_sections ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('english', title), 'A') || setweight(to_tsvector('english', content), 'B')
+) STORED;
 CREATE INDEX IF NOT EXISTS idx_doc_sections_embedding ON doc_sections USING hnsw (embedding vector_l2_ops);
+CREATE INDEX IF NOT EXISTS idx_doc_sections_search_vector ON doc_sections USING gin (search_vector);
+
+CREATE TABLE IF NOT EXISTS doc_sources (
+    url text PRIMARY KEY,
+    etag text
+);
+
+-- chunks seen by the current streaming ingestion, anything else is deleted when it completes
+CREATE TABLE IF NOT EXISTS doc_ingest_seen (
+    url text NOT NULL,
+    chunk_index int NOT NULL,
+    PRIMARY KEY (url, chunk_index)
+);
 """
 
 
@@ -195,8 +662,26 @@ def slugify(value: str, separator: str, unicode: bool = False) -> str:
   return re.sub(rf'[{separator}\s]+', separator, value)
 
 
-if __name__ == '__main__':
-  action = sys.argv[1] if len(sys.argv) > 1 else None
-  asyncio.run(build_search_db())
+async def main(action: str | None) -> None:
   q = 'How do I configure logfire to work with FastAPI?'
-  asyncio.run(run_agent(q))
+  # one event loop for every step, so they all share the pooled connections
+  async with HTTP_CLIENTS:
+    try:
+      if action == 'ingest':
+        await ingest_search_db()
+        await run_agent(q)
+      elif action == 'numpy':
+        await build_numpy_index()
+        await run_agent(q, backend='numpy')
+      elif action == 'bench':
+        await benchmark_retrievers([q])
+      else:
+        await build_search_db(rebuild=action == 'rebuild')
+        await run_agent(q)
+    finally:
+      await close_embeddings()
+      close_answer_cache()
+
+
+if __name__ == '__main__':
+  asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -0,0 +1,111 @@
+from __future__ import annotations as _annotations
+
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TypeAlias
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+@dataclass(frozen=True)
+class DuckDBTable:
+  """A table of a persistent DuckDB database, stored by reference since it already lives on disk."""
+
+  name: str
+
+
+Value: TypeAlias = pa.Table | DuckDBTable
+
+
+@dataclass
+class StoreStats:
+  # Arrow buffers allocated for results, memory-mapped values aren't counted
+  memory_bytes: int = 0
+  spills: int = 0
+  reloads: int = 0
+
+
+class ResultStore:
+  """`Out[n]` Arrow tables of an analysis, kept in memory within `memory_budget` bytes.
+
+  Once over budget, the least recently used values are spilled to uncompressed Arrow IPC files and
+  dropped from memory, `get` reloads them memory-mapped without copying. Values that are already
+  memory-mapped, like datasets from the HF cache or reloaded spills, live in the page cache rather
+  than the budget, so they're never spilled, nor are `DuckDBTable`s. Tables are immutable, so a value
+  is written at most once.
+  """
+
+  def __init__(self, memory_budget: int = 1 << 30, spill_dir: str | Path | None = None) -> None:
+    self.memory_budget = memory_budget
+    self.stats = StoreStats()
+    self._spill_dir = Path(spill_dir) if spill_dir is not None else None
+    self._tmp_dir: tempfile.TemporaryDirectory[str] | None = None
+    self._lock = threading.Lock()
+    # in memory values, least recently used first, with their size
+    self._memory: OrderedDict[str, tuple[Value, int]] = OrderedDict()
+    self._spilled: dict[str, Path] = {}
+    self._count = 0
+
+  def add(self, value: Value, memory_mapped: bool = False) -> str:
+    """Store the value, returning its reference such as `Out[1]`."""
+    with self._lock:
+      self._count += 1
+      ref = f'Out[{self._count}]'
+      in_memory = isinstance(value, pa.Table) and not memory_mapped
+      self._keep(ref, value, value.nbytes if in_memory else 0)
+      return ref
+
+  def get(self, ref: str) -> Value | None:
+    with self._lock:
+      if ref in self._memory:
+        self._memory.move_to_end(ref)
+        return self._memory[ref][0]
+      path = self._spilled.get(ref)
+      if path is None:
+        return None
+      value = feather.read_table(path, memory_map=True)
+      self.stats.reloads += 1
+      self._keep(ref, value, 0)
+      return value
+
+  def __contains__(self, ref: str) -> bool:
+    return ref in self._memory or ref in self._spilled
+
+  def __len__(self) -> int:
+    return self._count
+
+  def close(self) -> None:
+    if self._tmp_dir is not None:
+      self._tmp_dir.cleanup()
+
+  def _keep(self, ref: str, value: Value, size: int) -> None:
+    self._memory[ref] = (value, size)
+    self.stats.memory_bytes += size
+    while self.stats.memory_bytes > self.memory_budget:
+      # the value just stored stays in memory even if it's alone over budget, it's about to be used
+      victim = next((other for other, (_, other_size) in self._memory.items() if other_size and other != ref), None)
+      if victim is None:
+        break
+      self._evict(victim)
+
+  def _evict(self, ref: str) -> None:
+    value, size = self._memory.pop(ref)
+    assert isinstance(value, pa.Table), 'only in memory tables are evicted'
+    if ref not in self._spilled:
+      path = self._directory() / f'{ref[4:-1]}.arrow'
+      # uncompressed, so reloading can map the buffers instead of decompressing them
+      feather.write_feather(value, path, compression='uncompressed')
+      self._spilled[ref] = path
+      self.stats.spills += 1
+    self.stats.memory_bytes -= size
+
+  def _directory(self) -> Path:
+    if self._spill_dir is None:
+      self._tmp_dir = tempfile.TemporaryDirectory(prefix='analyst-results-')
+      self._spill_dir = Path(self._tmp_dir.name)
+    self._spill_dir.mkdir(parents=True, exist_ok=True)
+    return self._spill_dir
@@ -0,0 +1,122 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+
+
+def normalize_request(request: str) -> str:
+  """Case, whitespace and trailing punctuation don't change what a request asks for."""
+  return ' '.join(request.casefold().split()).rstrip('.?!')
+
+
+def schema_fingerprint(*parts: str) -> str:
+  """Hash of everything the generated SQL depends on besides the request, e.g. the schema and examples."""
+  digest = hashlib.sha256()
+  for part in parts:
+    digest.update(re.sub(r'\s+', ' ', part).strip().encode())
+    digest.update(b'\0')
+  return digest.hexdigest()[:16]
+
+
+@dataclass
+class PlanResult:
+  """Outcome of `EXPLAIN` for a query, the plan as JSON if it's valid, else the database error."""
+
+  plan_json: str | None = None
+  error: str | None = None
+
+  @property
+  def total_cost(self) -> float:
+    """The planner's estimated cost of the whole query."""
+    if self.plan_json is None:
+      return float('inf')
+    return json.loads(self.plan_json)[0]['Plan']['Total Cost']
+
+
+class SqlCache:
+  """Cache of validated NL-to-SQL outputs, keyed by the normalized request and a schema fingerprint.
+
+  Outputs are stored as JSON in SQLite, so they survive restarts. `EXPLAIN` results are memoized
+  in memory, so retries and repeated requests don't plan the same SQL again.
+  """
+
+  def __init__(self, path: str | Path, ttl: float = 24 * 60 * 60, max_plans: int = 1024) -> None:
+    self.ttl = ttl
+    self.max_plans = max_plans
+    self._plans: OrderedDict[tuple[str, str], PlanResult] = OrderedDict()
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    self._conn.executescript(
+      """
+      PRAGMA journal_mode = WAL;
+      CREATE TABLE IF NOT EXISTS outputs (
+          key TEXT PRIMARY KEY,
+          fingerprint TEXT NOT NULL,
+          request TEXT NOT NULL,
+          output_json TEXT NOT NULL,
+          created_at REAL NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS idx_outputs_fingerprint ON outputs (fingerprint);
+      """
+    )
+
+  @staticmethod
+  def key(request: str, fingerprint: str) -> str:
+    return hashlib.sha256(f'{fingerprint}\0{normalize_request(request)}'.encode()).hexdigest()
+
+  async def get(self, request: str, fingerprint: str) -> str | None:
+    """Return the cached output for the request under this schema, if there's an unexpired one."""
+    return await asyncio.to_thread(self._get, self.key(request, fingerprint))
+
+  async def put(self, request: str, fingerprint: str, output_json: str) -> None:
+    await asyncio.to_thread(self._put, self.key(request, fingerprint), fingerprint, request, output_json)
+
+  def invalidate(self, keep_fingerprints: Iterable[str] = ()) -> int:
+    """Drop outputs and plans for every other schema fingerprint, returning how many outputs were dropped."""
+    keep = list(keep_fingerprints)
+    with self._lock:
+      for plan_key in [plan_key for plan_key in self._plans if plan_key[0] not in keep]:
+        del self._plans[plan_key]
+      with self._conn:
+        placeholders = ','.join('?' * len(keep))
+        return self._conn.execute(f'DELETE FROM outputs WHERE fingerprint NOT IN ({placeholders})', keep).rowcount
+
+  def get_plan(self, sql: str, fingerprint: str) -> PlanResult | None:
+    with self._lock:
+      plan = self._plans.get((fingerprint, sql))
+      if plan is not None:
+        self._plans.move_to_end((fingerprint, sql))
+      return plan
+
+  def put_plan(self, sql: str, fingerprint: str, plan: PlanResult) -> None:
+    with self._lock:
+      self._plans[(fingerprint, sql)] = plan
+      self._plans.move_to_end((fingerprint, sql))
+      while len(self._plans) > self.max_plans:
+        self._plans.popitem(last=False)
+
+  def close(self) -> None:
+    self._conn.close()
+
+  def _get(self, key: str) -> str | None:
+    with self._lock:
+      row = self._conn.execute(
+        'SELECT output_json FROM outputs WHERE key = ? AND created_at >= ?', (key, time.time() - self.ttl)
+      ).fetchone()
+    return row[0] if row else None
+
+  def _put(self, key: str, fingerprint: str, request: str, output_json: str) -> None:
+    with self._lock, self._conn:
+      self._conn.execute(
+        'INSERT OR REPLACE INTO outputs (key, fingerprint, request, output_json, created_at) VALUES (?, ?, ?, ?, ?)',
+        (key, fingerprint, request, output_json, time.time()),
+      )
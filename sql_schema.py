@@ -0,0 +1,241 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import math
+import re
+import time
+from collections import defaultdict
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, field
+from typing import Any
+
+import asyncpg
+import logfire
+
+from sql_cache import schema_fingerprint
+
+SCHEMA_CHANGED_CHANNEL = 'sql_gen_schema_changed'
+# notifies `SCHEMA_CHANGED_CHANNEL` after every DDL command, so cached catalogs are invalidated straight away
+DDL_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION sql_gen_notify_ddl() RETURNS event_trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('{SCHEMA_CHANGED_CHANNEL}', '');
+END $$;
+DROP EVENT TRIGGER IF EXISTS sql_gen_schema_changed;
+CREATE EVENT TRIGGER sql_gen_schema_changed ON ddl_command_end EXECUTE FUNCTION sql_gen_notify_ddl();
+"""
+COLUMNS_SQL = """
+SELECT n.nspname, c.relname, a.attname, format_type(a.atttypid, a.atttypmod), t.typname,
+       obj_description(c.oid, 'pg_class'), col_description(c.oid, a.attnum)
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_attribute a ON a.attrelid = c.oid
+JOIN pg_type t ON t.oid = a.atttypid
+WHERE n.nspname = ANY($1::text[]) AND c.relkind IN ('r', 'v', 'm', 'p') AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY n.nspname, c.relname, a.attnum
+"""
+ENUMS_SQL = """
+SELECT t.typname, array_agg(e.enumlabel ORDER BY e.enumsortorder)
+FROM pg_type t
+JOIN pg_enum e ON e.enumtypid = t.oid
+JOIN pg_namespace n ON n.oid = t.typnamespace
+WHERE n.nspname = ANY($1::text[])
+GROUP BY t.typname
+"""
+STOPWORDS = frozenset(
+  'a all an and any are as at be by do does for from get give i in is it list me of on or show tell '
+  'that the their there these this to was were what when where which who with'.split()
+)
+
+
+def tokenize(text: str) -> set[str]:
+  """Lowercase word stems of text or identifiers, `startTimestamp` and `start_timestamps` give the same tokens."""
+  words = re.findall(r'[a-z0-9]+', re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', text).lower())
+  return {stem(word) for word in words if word not in STOPWORDS}
+
+
+def stem(word: str) -> str:
+  if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+    return word[:-1]
+  return word
+
+
+@dataclass
+class Column:
+  name: str
+  data_type: str
+  comment: str | None = None
+  # labels when the column's type is an enum, they're the values requests mention, e.g. "error"
+  enum_labels: list[str] = field(default_factory=list)
+
+  def tokens(self) -> set[str]:
+    return tokenize(' '.join([self.name, self.comment or '', *self.enum_labels]))
+
+
+@dataclass
+class Table:
+  name: str
+  columns: list[Column]
+  comment: str | None = None
+
+  def render(self, columns: Sequence[Column] | None = None) -> str:
+    lines = [f'    {column.name} {column.data_type}' for column in columns or self.columns]
+    ddl = f'CREATE TABLE {self.name} (\n' + ',\n'.join(lines) + '\n);'
+    if self.comment:
+      ddl = f'-- {self.comment}\n{ddl}'
+    return ddl
+
+
+@dataclass
+class SchemaCatalog:
+  """Tables and enums of a database, with a keyword index over their names, comments and enum labels."""
+
+  tables: list[Table]
+  enums: dict[str, list[str]]
+  fingerprint: str = field(init=False)
+  _index: dict[str, dict[str, float]] = field(init=False, repr=False)
+
+  def __post_init__(self) -> None:
+    self.fingerprint = schema_fingerprint(
+      *(table.render() for table in self.tables), *(f'{name} {labels}' for name, labels in sorted(self.enums.items()))
+    )
+    # token -> table -> weight, a table's own name counts more than its columns
+    self._index = defaultdict(dict)
+    for table in self.tables:
+      for token in tokenize(table.name):
+        self._index[token][table.name] = 2.0
+      for column in table.columns:
+        for token in column.tokens() - tokenize(table.name):
+          self._index[token].setdefault(table.name, 1.0)
+
+  def relevant_tables(self, request: str, max_tables: int, max_columns: int) -> list[tuple[Table, list[Column]]]:
+    """Tables most relevant to the request by keyword, each with at most `max_columns` columns.
+
+    Tokens found in fewer tables weigh more. Wide tables keep the columns the request mentions,
+    then their first columns. Without any match, the first tables are returned so the prompt isn't empty.
+    """
+    request_tokens = tokenize(request)
+    scores: dict[str, float] = defaultdict(float)
+    for token in request_tokens:
+      tables = self._index.get(token, {})
+      idf = math.log(1 + len(self.tables) / len(tables)) if tables else 0.0
+      for name, weight in tables.items():
+        scores[name] += weight * idf
+
+    by_name = {table.name: table for table in self.tables}
+    ranked = sorted(scores, key=lambda name: (-scores[name], name))[:max_tables] or list(by_name)[:max_tables]
+    selected: list[tuple[Table, list[Column]]] = []
+    for name in ranked:
+      table = by_name[name]
+      columns = table.columns
+      if len(columns) > max_columns:
+        matching = [column for column in columns if column.tokens() & request_tokens][:max_columns]
+        rest = [column for column in columns if column not in matching][: max_columns - len(matching)]
+        # keep the table's column order
+        keep = {column.name for column in matching + rest}
+        columns = [column for column in columns if column.name in keep]
+      selected.append((table, columns))
+    return selected
+
+  def render(self, selected: Sequence[tuple[Table, Sequence[Column]]]) -> str:
+    """DDL of the selected tables and columns, preceded by the enums they use."""
+    enum_names = {column.data_type for _, columns in selected for column in columns if column.enum_labels}
+    enums = [
+      f"CREATE TYPE {name} AS ENUM ({', '.join(repr(label) for label in self.enums[name])});"
+      for name in sorted(enum_names)
+      if name in self.enums
+    ]
+    return '\n\n'.join([*enums, *(table.render(columns) for table, columns in selected)])
+
+
+def closest_examples(examples: Sequence[dict[str, str]], request: str, k: int) -> list[dict[str, str]]:
+  """The `k` examples whose requests share most words with this one, by Jaccard similarity."""
+  request_tokens = tokenize(request)
+
+  def similarity(example: dict[str, str]) -> float:
+    tokens = tokenize(example['request'])
+    union = tokens | request_tokens
+    return len(tokens & request_tokens) / len(union) if union else 0.0
+
+  return sorted(examples, key=similarity, reverse=True)[:k]
+
+
+async def introspect(conn: asyncpg.Connection, schemas: Sequence[str] = ('public',)) -> SchemaCatalog:
+  enums: dict[str, list[str]] = {name: list(labels) for name, labels in await conn.fetch(ENUMS_SQL, list(schemas))}
+  tables: dict[str, Table] = {}
+  for schema, table_name, column_name, data_type, type_name, table_comment, column_comment in await conn.fetch(
+    COLUMNS_SQL, list(schemas)
+  ):
+    name = table_name if schema == 'public' else f'{schema}.{table_name}'
+    table = tables.setdefault(name, Table(name, [], table_comment))
+    table.columns.append(Column(column_name, data_type, column_comment, enums.get(type_name, [])))
+  return SchemaCatalog(list(tables.values()), enums)
+
+
+class SchemaCache:
+  """Introspected catalog of a database, reloaded after DDL changes.
+
+  With `start`, a pooled connection listens for the notifications of `DDL_TRIGGER_SQL`. Catalogs are
+  also reloaded once older than `max_age`, in case the trigger couldn't be installed.
+  """
+
+  def __init__(
+    self,
+    pool: asyncpg.Pool,
+    schemas: Sequence[str] = ('public',),
+    max_age: float = 5 * 60,
+    on_change: Callable[[SchemaCatalog], Any] | None = None,
+  ) -> None:
+    self.pool = pool
+    self.schemas = schemas
+    self.max_age = max_age
+    self.on_change = on_change
+    self._catalog: SchemaCatalog | None = None
+    self._loaded_at = 0.0
+    self._invalidated_at = 0.0
+    self._lock = asyncio.Lock()
+    self._listener: asyncpg.Connection | None = None
+
+  async def start(self) -> None:
+    self._listener = await self.pool.acquire()
+    await self._listener.add_listener(SCHEMA_CHANGED_CHANNEL, self._on_notification)
+
+  async def stop(self) -> None:
+    if self._listener is not None:
+      await self._listener.remove_listener(SCHEMA_CHANGED_CHANNEL, self._on_notification)
+      await self.pool.release(self._listener)
+      self._listener = None
+
+  async def get(self) -> SchemaCatalog:
+    if self._is_stale():
+      # concurrent requests share one introspection
+      async with self._lock:
+        if self._is_stale():
+          await self._load()
+    assert self._catalog is not None
+    return self._catalog
+
+  def invalidate(self) -> None:
+    self._invalidated_at = time.monotonic()
+
+  def _is_stale(self) -> bool:
+    return (
+      self._catalog is None
+      or self._invalidated_at >= self._loaded_at
+      or time.monotonic() - self._loaded_at > self.max_age
+    )
+
+  async def _load(self) -> None:
+    # taken before introspecting, so DDL notified meanwhile still invalidates this catalog
+    started = time.monotonic()
+    with logfire.span('introspect schema'):
+      async with self.pool.acquire() as conn:
+        catalog = await introspect(conn, self.schemas)
+    changed = self._catalog is not None and catalog.fingerprint != self._catalog.fingerprint
+    self._catalog = catalog
+    self._loaded_at = started
+    if changed and self.on_change is not None:
+      self.on_change(catalog)
+
+  def _on_notification(self, *_args: Any) -> None:
+    self.invalidate()
@@ -0,0 +1,179 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import json
+from collections.abc import Sequence
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Protocol
+
+import numpy as np
+import numpy.typing as npt
+
+from embeddings import Vector
+
+EMBEDDINGS_FILE = 'embeddings.f32'
+NORMS_FILE = 'norms.f32'
+CENTROIDS_FILE = 'centroids.npy'
+METADATA_FILE = 'sections.json'
+
+
+@dataclass
+class SectionHit:
+  """A documentation section returned by a retriever, with its L2 distance to the query."""
+
+  url: str
+  title: str
+  content: str
+  distance: float = 0.0
+
+
+class Retriever(Protocol):
+  async def search(self, embedding: Vector, k: int) -> list[SectionHit]:
+    """Return the `k` sections nearest to `embedding`, closest first."""
+    ...
+
+  async def text_search(self, query: str, k: int) -> list[SectionHit]:
+    """Return up to `k` sections matching `query` lexically, best first."""
+    ...
+
+
+def reciprocal_rank_fusion(*rankings: list[SectionHit], k: int, rrf_k: int = 60) -> list[SectionHit]:
+  """Merge ranked result lists by reciprocal-rank fusion, dropping duplicate contents."""
+  scores: dict[tuple[str, str], float] = {}
+  hits: dict[tuple[str, str], SectionHit] = {}
+  for ranking in rankings:
+    for rank, hit in enumerate(ranking):
+      key = (hit.url, hit.content)
+      scores[key] = scores.get(key, 0.0) + 1 / (rrf_k + rank + 1)
+      # keep the vector hit when both legs return a section, it carries the distance
+      hits.setdefault(key, hit)
+
+  merged: list[SectionHit] = []
+  seen_contents: set[str] = set()
+  for key in sorted(scores, key=scores.__getitem__, reverse=True):
+    hit = hits[key]
+    if hit.content in seen_contents:
+      continue
+    seen_contents.add(hit.content)
+    merged.append(hit)
+    if len(merged) == k:
+      break
+  return merged
+
+
+class NumpyRetriever:
+  """In-process retriever over a memory-mapped float32 embedding matrix.
+
+  Without centroids the search is an exact, vectorized L2 top-k over all rows. When the index
+  was built with `n_lists`, rows are grouped by k-means cluster (IVF) and only the `n_probe`
+  nearest clusters are scanned.
+  """
+
+  def __init__(self, directory: str | Path, n_probe: int = 8) -> None:
+    directory = Path(directory)
+    metadata = json.loads((directory / METADATA_FILE).read_text())
+    self.sections = [SectionHit(**section) for section in metadata['sections']]
+    self.n_probe = n_probe
+    dim = metadata['dim']
+    self.embeddings: npt.NDArray[np.float32] = np.memmap(
+      directory / EMBEDDINGS_FILE, dtype=np.float32, mode='r', shape=(len(self.sections), dim)
+    )
+    # squared row norms are computed once at build time, so opening the index doesn't read the whole matrix
+    self.norms: npt.NDArray[np.float32] = np.memmap(
+      directory / NORMS_FILE, dtype=np.float32, mode='r', shape=(len(self.sections),)
+    )
+    self.offsets: npt.NDArray[np.int64] | None = None
+    self.centroids: npt.NDArray[np.float32] | None = None
+    if metadata['offsets'] is not None:
+      self.offsets = np.asarray(metadata['offsets'], dtype=np.int64)
+      self.centroids = np.load(directory / CENTROIDS_FILE)
+      self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+  @classmethod
+  def build(
+    cls,
+    directory: str | Path,
+    sections: Sequence[SectionHit],
+    embeddings: Sequence[Vector],
+    n_lists: int | None = None,
+  ) -> NumpyRetriever:
+    """Persist `sections` and their embeddings to `directory`, optionally with an IVF index of `n_lists` clusters."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    matrix = np.asarray(np.stack(embeddings), dtype=np.float32)
+
+    offsets = None
+    if n_lists is not None and n_lists < len(matrix):
+      centroids, assignments = kmeans(matrix, n_lists)
+      order = np.argsort(assignments, kind='stable')
+      matrix = matrix[order]
+      sections = [sections[i] for i in order]
+      offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1)).tolist()
+      np.save(directory / CENTROIDS_FILE, centroids)
+
+    matrix.tofile(directory / EMBEDDINGS_FILE)
+    np.einsum('ij,ij->i', matrix, matrix).tofile(directory / NORMS_FILE)
+    metadata = {'dim': matrix.shape[1], 'offsets': offsets, 'sections': [asdict(section) for section in sections]}
+    (directory / METADATA_FILE).write_text(json.dumps(metadata))
+    return cls(directory)
+
+  async def search(self, embedding: Vector, k: int) -> list[SectionHit]:
+    if self.centroids is None:
+      # the exact scan reads the whole matrix, numpy releases the GIL so it runs off the event loop
+      return await asyncio.to_thread(self.search_sync, embedding, k)
+    return self.search_sync(embedding, k)
+
+  async def text_search(self, query: str, k: int) -> list[SectionHit]:
+    # there's no lexical index in-process, so hybrid retrieval degrades to vector-only
+    return []
+
+  def search_sync(self, embedding: Vector, k: int) -> list[SectionHit]:
+    query = np.asarray(embedding, dtype=np.float32)
+    if self.centroids is None or self.offsets is None:
+      rows = np.arange(len(self.sections))
+      distances = self.norms - 2 * (self.embeddings @ query)
+    else:
+      probe = np.argsort(self.centroid_norms - 2 * (self.centroids @ query))[: self.n_probe]
+      # each cluster's rows are contiguous, so slice them rather than gather them with fancy indexing
+      bounds = [(self.offsets[c], self.offsets[c + 1]) for c in probe]
+      rows = np.concatenate([np.arange(start, end) for start, end in bounds])
+      distances = np.concatenate(
+        [self.norms[start:end] - 2 * (self.embeddings[start:end] @ query) for start, end in bounds]
+      )
+
+    k = min(k, len(rows))
+    if k == 0:
+      return []
+    top = np.argpartition(distances, k - 1)[:k]
+    top = top[np.argsort(distances[top])]
+    # add back |q|^2, dropped above since it doesn't change the ranking
+    l2 = np.sqrt(np.maximum(distances[top] + query @ query, 0))
+    hits: list[SectionHit] = []
+    for i, distance in zip(rows[top], l2):
+      section = self.sections[i]
+      hits.append(SectionHit(section.url, section.title, section.content, float(distance)))
+    return hits
+
+
+def kmeans(
+  matrix: npt.NDArray[np.float32], n_clusters: int, iterations: int = 10, seed: int = 0
+) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+  """Lloyd's k-means, returning the centroids and each row's cluster."""
+  rng = np.random.default_rng(seed)
+  centroids = matrix[rng.choice(len(matrix), n_clusters, replace=False)].copy()
+  norms = np.einsum('ij,ij->i', matrix, matrix)
+  for _ in range(iterations):
+    assignments = nearest_centroids(matrix, norms, centroids)
+    for c in range(n_clusters):
+      members = matrix[assignments == c]
+      if len(members):
+        centroids[c] = members.mean(axis=0)
+  return centroids, nearest_centroids(matrix, norms, centroids)
+
+
+def nearest_centroids(
+  matrix: npt.NDArray[np.float32], norms: npt.NDArray[np.float32], centroids: npt.NDArray[np.float32]
+) -> npt.NDArray[np.int64]:
+  centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+  return np.argmin(norms[:, None] - 2 * (matrix @ centroids.T) + centroid_norms, axis=1)
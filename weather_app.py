@@ -1,7 +1,7 @@
 from __future__ import annotations as _annotations
 
 import asyncio
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any
 
 from byeprint import p
@@ -10,11 +10,22 @@ from pydantic import BaseModel
 from pydantic_ai import Agent, RunContext
 
 from constant import model
+from http_cache import ResponseCache
+from http_clients import HTTP_CLIENTS
+
+LATLNG_URL = 'https://demo-endpoints.pydantic.workers.dev/latlng'
+NUMBER_URL = 'https://demo-endpoints.pydantic.workers.dev/number'
+WEATHER_URL = 'https://demo-endpoints.pydantic.workers.dev/weather'
+# geocodes barely change, the weather does; the random temperature isn't tied to a location, so it's never cached
+ENDPOINT_TTLS = {LATLNG_URL: 30 * 24 * 60 * 60, WEATHER_URL: 10 * 60}
+WEATHER_CACHE_FILE = 'weather_cache.sqlite'
 
 
 @dataclass
 class Deps:
   client: AsyncClient
+  # pass the same cache to every run's deps to share it, the default one only lives as long as these deps
+  cache: ResponseCache = field(default_factory=lambda: ResponseCache(ENDPOINT_TTLS))
 
 
 weather_agent = Agent(
@@ -32,10 +43,7 @@ class LatLng(BaseModel):
 
 @weather_agent.tool
 async def get_lat_lng(ctx: RunContext[Deps], location_description: str) -> LatLng:
-  r = await ctx.deps.client.get(
-    url='https://demo-endpoints.pydantic.workers.dev/latlng',
-    params={'location': location_description},
-  )
+  r = await ctx.deps.cache.get(ctx.deps.client, LATLNG_URL, params={'location': location_description})
   r.raise_for_status()
   p(r.raise_for_status())
   p(r.content)
@@ -46,14 +54,8 @@ async def get_lat_lng(ctx: RunContext[Deps], location_description: str) -> LatLn
 @weather_agent.tool
 async def get_weather(ctx: RunContext[Deps], lat: float, lng: float) -> dict[str, Any]:
   temp_response, descr_response = await asyncio.gather(
-    ctx.deps.client.get(
-      url='https://demo-endpoints.pydantic.workers.dev/number',
-      params={'min': 10, 'max': 30},
-    ),
-    ctx.deps.client.get(
-      url='https://demo-endpoints.pydantic.workers.dev/weather',
-      params={'lat': lat, 'lng': lng},
-    ),
+    ctx.deps.cache.get(ctx.deps.client, NUMBER_URL, params={'min': 10, 'max': 30}),
+    ctx.deps.cache.get(ctx.deps.client, WEATHER_URL, params={'lat': lat, 'lng': lng}),
   )
   temp_response.raise_for_status()
   descr_response.raise_for_status()
@@ -70,10 +72,13 @@ async def get_weather(ctx: RunContext[Deps], lat: float, lng: float) -> dict[str
 
 
 async def main() -> None:
-  async with AsyncClient() as client:
-    deps = Deps(client=client)
+  cache = ResponseCache(ENDPOINT_TTLS, path=WEATHER_CACHE_FILE, persistent=[LATLNG_URL])
+  async with HTTP_CLIENTS:
+    deps = Deps(client=HTTP_CLIENTS.get(), cache=cache)
     result = await weather_agent.run('What is the weather like in Vietnam and in Wiltshire?', deps=deps)  # type: ignore
     p('Response:', result.output)
+  p(cache.stats, f'hit rate {cache.stats.hit_rate:.0%}')
+  cache.close()
 
 
 if __name__ == '__main__':